@@ -4,6 +4,7 @@ from django.contrib.auth.models import Group
 from django.utils.translation import gettext_lazy as _
 from mptt.admin import MPTTModelAdmin
 
+from obcine.filters import TaskDurationListFilter, TaskStatusListFilter
 from obcine.models import (
     FinancialYear,
     Instructions,
@@ -70,6 +71,7 @@ class RevenueDefinitionAdmin(MPTTModelAdmin):
 
 class DocumentTabularInline(admin.TabularInline):
     exclude = ["municipality", "year"]
+    readonly_fields = ["import_fingerprint"]
 
 
 class ExpenseDocumentTabularInline(DocumentTabularInline):
@@ -157,7 +159,18 @@ class RevenueAdmin(admin.ModelAdmin):
 
 
 class TaskAdmin(admin.ModelAdmin):
-    list_display = ["name"]
+    list_display = [
+        "name",
+        "municipality",
+        "lane",
+        "status",
+        "created_at",
+        "started_at",
+        "duration",
+        "attempts",
+        "timings_summary",
+    ]
+    list_filter = [TaskStatusListFilter, TaskDurationListFilter, "lane"]
 
 
 class MonthlyRevenueRealizatioObcineAdmin(admin.ModelAdmin):
@@ -1,7 +1,10 @@
+from datetime import timedelta
+
 from django.contrib import admin
+from django.db.models import DurationField, ExpressionWrapper, F
 from django.utils.translation import gettext_lazy as _
 
-from obcine.models import FinancialYear
+from obcine.models import FinancialYear, Task
 
 
 class SimpleFinanceYearListFilter(admin.SimpleListFilter):
@@ -35,3 +38,47 @@ class SimpleFinanceYearListFilter(admin.SimpleListFilter):
                 ),
                 "display": title,
             }
+
+
+class TaskStatusListFilter(admin.SimpleListFilter):
+    title = _("Status")
+    parameter_name = "status"
+
+    def lookups(self, request, model_admin):
+        return ((status, status) for status in Task.get_status_filters())
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(Task.get_status_filters()[self.value()])
+
+
+class TaskDurationListFilter(admin.SimpleListFilter):
+    title = _("Duration")
+    parameter_name = "duration"
+    ranges = {
+        "short": (None, timedelta(minutes=1)),
+        "medium": (timedelta(minutes=1), timedelta(minutes=10)),
+        "long": (timedelta(minutes=10), None),
+    }
+
+    def lookups(self, request, model_admin):
+        return (
+            ("short", _("Under 1 minute")),
+            ("medium", _("1 to 10 minutes")),
+            ("long", _("Over 10 minutes")),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value() not in self.ranges:
+            return queryset
+        low, high = self.ranges[self.value()]
+        queryset = queryset.annotate(
+            run_duration=ExpressionWrapper(
+                F("finished_at") - F("started_at"), output_field=DurationField()
+            )
+        ).filter(finished_at__isnull=False, started_at__isnull=False)
+        if low is not None:
+            queryset = queryset.filter(run_duration__gte=low)
+        if high is not None:
+            queryset = queryset.filter(run_duration__lt=high)
+        return queryset
@@ -0,0 +1,109 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from obcine import models
+from obcine.parse_utils import XLSXAppraBudget
+
+
+def get_synthetic_rows(row_count):
+    """
+    Generates rows of APPRA budget export, every fifth row repeats a k4
+    """
+    for i in range(row_count):
+        leaf = i - i % 5 if i % 5 == 4 else i
+        ppp_id = f"{leaf // 10000:02}"
+        gpr_id = f"{ppp_id}{leaf // 1000 % 10:02}"
+        ppr_id = f"{gpr_id}{leaf // 100 % 10:04}"
+        pp_id = f"{leaf // 10:05}"
+        k4_id = f"4{leaf % 10:03}"
+        yield [
+            "",
+            "",
+            ppp_id,
+            f"PPP {ppp_id}",
+            gpr_id,
+            f"GPR {gpr_id}",
+            ppr_id,
+            f"PPR {ppr_id}",
+            pp_id,
+            f"PP {pp_id}",
+            k4_id,
+            f"K4 {k4_id}",
+            "",
+            "",
+            0,
+            0,
+            100.25,
+        ]
+
+
+def create_benchmark_document():
+    """
+    Creates a municipality with an empty budget document, call it in a
+    transaction which is rolled back
+    """
+    if not models.FinancialYear.objects.exists():
+        models.FinancialYear(
+            name="2000", start_date="2000-01-01", end_date="2000-12-31"
+        ).save()
+    # on save signal creates municipality years and empty documents
+    municipality = models.Municipality(name="Benchmark")
+    municipality.save()
+    return models.PlannedExpenseDocument.objects.get(
+        municipality_year=municipality.municipalityfinancialyears.first()
+    )
+
+
+class Command(BaseCommand):
+    help = "Measure duration and number of queries of a budget import"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "file_path",
+            nargs="?",
+            default="files/proracun_apra.xlsx",
+            help="APPRA budget export",
+        )
+        parser.add_argument(
+            "--synthetic",
+            nargs="+",
+            type=int,
+            default=[],
+            help="Import generated sheets with given numbers of rows instead of a file",
+        )
+
+    def handle(self, *args, **options):
+        if options["synthetic"]:
+            for row_count in options["synthetic"]:
+                self.stdout.write(f"rows: {row_count}, ", ending="")
+                self.benchmark(
+                    lambda parser: parser.import_rows(get_synthetic_rows(row_count))
+                )
+        else:
+            self.benchmark(
+                lambda parser: parser.parse_file(file_path=options["file_path"])
+            )
+
+    def benchmark(self, run_import):
+        # everything is rolled back at the end, the database stays untouched
+        with transaction.atomic():
+            document = create_benchmark_document()
+            parser = XLSXAppraBudget(document, model=models.PlannedExpense)
+            with CaptureQueriesContext(connection) as queries:
+                start_time = time.time()
+                run_import(parser)
+                duration = time.time() - start_time
+
+            nodes = models.PlannedExpense.objects.filter(document=document).count()
+            self.stdout.write(
+                f"nodes: {nodes}, queries: {len(queries)}, seconds: {duration:.2f}"
+            )
+            for name, phase in parser.timer.phases.items():
+                self.stdout.write(
+                    f"  {name}: {phase['seconds']:.2f} s, "
+                    f"{phase['queries']} queries, {phase['rows']} rows"
+                )
+            transaction.set_rollback(True)
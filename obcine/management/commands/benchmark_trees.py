@@ -0,0 +1,119 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from obcine import models
+from obcine.management.commands.benchmark_import import (
+    create_benchmark_document,
+    get_synthetic_rows,
+)
+from obcine.parse_utils import XLSXAppraBudget
+from obcine.tree_utils import ExpenseTreeBuilder
+
+
+def build_tree_by_levels(definiton_storage, items):
+    """
+    Previous implementation of build_tree, kept to compare against. Adds
+    parents to one level of nodes at a time, all leaves have to be on the
+    same level.
+    """
+    parent_level = {}
+    parent = None
+
+    for item in items:
+        parent = definiton_storage[item["parent_id"]]
+        if parent.id in parent_level.keys():
+            parent_level[parent.id]["amount"] += item["amount"]
+            parent_level[parent.id]["children"].append(item)
+        else:
+            parent.amount = item["amount"]
+            parent.children = [item]
+            parent_level[parent.id] = parent.get_offline_dict()
+
+    if parent and parent.parent:
+        return build_tree_by_levels(definiton_storage, parent_level.values())
+    else:
+        return parent_level
+
+
+def get_expense_tree_from_instances(municipality, year, data_model):
+    """
+    Previous implementation of ExpenseTreeBuilder.get_expense_tree, which
+    adds parents to the leaves from model instances
+    """
+    expenses = data_model.objects.filter(municipality=municipality, year=year)
+    definiton_storage = {expense.id: expense for expense in expenses}
+    return list(
+        build_tree_by_levels(
+            definiton_storage,
+            [expense.get_offline_dict() for expense in expenses.filter(level=4)],
+        ).values()
+    )
+
+
+class Command(BaseCommand):
+    help = "Compare duration and number of queries of building the expense tree"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "file_path",
+            nargs="?",
+            default="files/proracun_apra.xlsx",
+            help="APPRA budget export",
+        )
+        parser.add_argument(
+            "--synthetic",
+            type=int,
+            help="Import a generated sheet with the number of rows instead of a file",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Number of times each tree is built",
+        )
+
+    def handle(self, *args, **options):
+        # everything is rolled back at the end, the database stays untouched
+        with transaction.atomic():
+            document = create_benchmark_document()
+            municipality = document.municipality_year.municipality
+            year = document.municipality_year.financial_year
+
+            parser = XLSXAppraBudget(document, model=models.PlannedExpense)
+            if options["synthetic"]:
+                parser.import_rows(get_synthetic_rows(options["synthetic"]))
+            else:
+                parser.parse_file(file_path=options["file_path"])
+            nodes = models.PlannedExpense.objects.filter(document=document).count()
+            self.stdout.write(f"nodes: {nodes}")
+
+            builder = ExpenseTreeBuilder(municipality, year)
+            trees = {}
+            for name, build in [
+                (
+                    "from instances",
+                    lambda: get_expense_tree_from_instances(
+                        municipality, year, models.PlannedExpense
+                    ),
+                ),
+                (
+                    "from rows",
+                    lambda: builder.get_expense_tree(models.PlannedExpense),
+                ),
+            ]:
+                durations = []
+                for i in range(options["repeat"]):
+                    with CaptureQueriesContext(connection) as queries:
+                        start_time = time.perf_counter()
+                        trees[name] = build()
+                        durations.append(time.perf_counter() - start_time)
+                self.stdout.write(
+                    f"  {name}: {min(durations):.3f} s, {len(queries)} queries"
+                )
+
+            if trees["from instances"] != trees["from rows"]:
+                self.stderr.write("Trees are not equal")
+            transaction.set_rollback(True)
@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from obcine.models import Task
+
+
+class Command(BaseCommand):
+    help = "Delete finished, skipped and failed tasks older than the retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.TASK_RETENTION_DAYS,
+            help="Keep tasks which ended in the last number of days",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of tasks deleted in one query",
+        )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options["days"])
+        ended = (
+            Q(finished_at__lt=before)
+            | Q(skipped_at__lt=before)
+            | Q(errored_at__lt=before)
+        )
+
+        deleted = 0
+        # short deletes don't hold locks which would block the runners
+        while True:
+            ids = list(
+                Task.objects.filter(ended).values_list("id", flat=True)[
+                    : options["batch_size"]
+                ]
+            )
+            if not ids:
+                break
+            Task.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+
+        self.stdout.write(f"Deleted {deleted} tasks")
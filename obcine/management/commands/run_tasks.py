@@ -1,23 +1,233 @@
-from datetime import datetime
-from importlib import import_module
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
 from django.conf import settings
-from django.contrib.auth.models import Group
-from django.core.management.base import BaseCommand, CommandError
-from django.utils.translation import gettext as _
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
 
 from obcine.models import Task
 
+logger = logging.getLogger(__name__)
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+def raise_timeout(signum, frame):
+    raise TaskTimeout(f"Task did not finish in {settings.TASK_TIMEOUT} seconds")
+
+
+def run_task(task_id):
+    """
+    Runs the task and aborts it after TASK_TIMEOUT seconds, e.g. when the
+    download hangs. The timeout is recorded as a failure of the task.
+    """
+    # pool processes open their own database connection
+    task = Task.objects.get(id=task_id)
+    signal.signal(signal.SIGALRM, raise_timeout)
+    signal.alarm(settings.TASK_TIMEOUT)
+    try:
+        task.run()
+    finally:
+        signal.alarm(0)
+
+
+def get_task_key(task):
+    """
+    Tasks with the same key import the same document into the same rows
+    """
+    return (task.payload.get("self"), task.payload.get("pk"))
+
 
 class Command(BaseCommand):
-    help = "Run "
+    help = "Run pending tasks"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--worker",
+            action="store_true",
+            help="Keep running and run new tasks as they are created",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=1,
+            help="Seconds between checks for new tasks after a task was run",
+        )
+        parser.add_argument(
+            "--max-poll-interval",
+            type=float,
+            default=5,
+            help="Longest pause between checks while there are no tasks",
+        )
+        parser.add_argument(
+            "--lane",
+            choices=Task.Lane.values,
+            help="Run only tasks of the lane, tasks of all lanes are run by default",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=1,
+            help="Number of processes running tasks at the same time",
+        )
 
     def handle(self, *args, **options):
-        tasks = Task.objects.filter(started_at__isnull=True).order_by("created_at")
-        msgs = []
-        for task in tasks:
-            # skip task if it's started in another runner
-            check_task = Task.objects.get(id=task.id)
-            if check_task.started_at:
-                continue
-            task.run()
+        self.concurrency = options["concurrency"]
+        self.lane = options["lane"]
+        if options["worker"]:
+            self.run_worker(options["poll_interval"], options["max_poll_interval"])
+        else:
+            self.run_pending_tasks()
+
+    def run_pending_tasks(self, stop=None):
+        """
+        Runs tasks which are not started yet and returns how many were run
+        """
+        start_time = time.time()
+        if self.concurrency > 1:
+            count = self.run_tasks_in_pool(stop)
+        else:
+            count = self.run_tasks(stop)
+
+        if count:
+            duration = time.time() - start_time
+            self.stdout.write(
+                f"Ran {count} tasks in {duration:.1f} seconds "
+                f"({count / duration:.2f} tasks per second)"
+            )
+        return count
+
+    def run_tasks(self, stop):
+        count = 0
+        while not (stop and stop.is_set()):
+            # other runners can claim tasks at the same time
+            task = Task.claim(lane=self.lane)
+            if not task:
+                break
+            try:
+                run_task(task.id)
+            except Exception:
+                self.handle_task_error(task.id)
+            count += 1
+        return count
+
+    def run_tasks_in_pool(self, stop):
+        """
+        Runs claimed tasks in a pool of processes. Tasks of the same document
+        wait until the previous one finishes, so they run in order.
+        """
+        count = 0
+        futures = {}
+        running_keys = set()
+        waiting_tasks = {}
+        queue_is_empty = False
+        pool_is_broken = False
+
+        # forked processes inherit the loaded django setup
+        executor = ProcessPoolExecutor(
+            max_workers=self.concurrency, mp_context=multiprocessing.get_context("fork")
+        )
+        with executor:
+
+            def submit(task_id, key):
+                """
+                Returns False if the pool can't run tasks anymore
+                """
+                # a forked process must not share the connection of this one
+                connections.close_all()
+                try:
+                    futures[executor.submit(run_task, task_id)] = (task_id, key)
+                except BrokenProcessPool:
+                    # claimed tasks of the key are retried by the next pool
+                    self.handle_task_error(task_id)
+                    for waiting_task_id in waiting_tasks.pop(key, []):
+                        self.handle_task_error(waiting_task_id)
+                    return False
+                running_keys.add(key)
+                return True
+
+            while True:
+                claimed = len(futures) + sum(map(len, waiting_tasks.values()))
+                while claimed < self.concurrency and not queue_is_empty:
+                    if pool_is_broken:
+                        break
+                    if stop and stop.is_set():
+                        break
+                    task = Task.claim(lane=self.lane)
+                    if not task:
+                        queue_is_empty = True
+                        break
+                    claimed += 1
+                    key = get_task_key(task)
+                    if key in running_keys:
+                        waiting_tasks.setdefault(key, deque()).append(task.id)
+                    elif not submit(task.id, key):
+                        pool_is_broken = True
+
+                if not futures:
+                    return count
+
+                done = wait(futures, return_when=FIRST_COMPLETED).done
+                for future in done:
+                    task_id, key = futures.pop(future)
+                    running_keys.remove(key)
+                    try:
+                        future.result()
+                    except Exception:
+                        # e.g. the process of the task was killed
+                        self.handle_task_error(task_id)
+                    count += 1
+                    # claimed tasks are run even if the worker is stopping
+                    if waiting_tasks.get(key):
+                        if not submit(waiting_tasks[key].popleft(), key):
+                            pool_is_broken = True
+                    else:
+                        waiting_tasks.pop(key, None)
+                # new tasks could be created in the meantime
+                queue_is_empty = False
+
+    def handle_task_error(self, task_id):
+        """
+        Logs an exception which escaped Task.run and records it on the task,
+        so the task is retried instead of staying claimed by this runner
+        """
+        logger.exception("Task %s did not finish", task_id)
+        # the database connection could be broken
+        close_old_connections()
+        try:
+            task = Task.objects.get(id=task_id)
+            if task.status() == "running":
+                task.fail()
+        except Exception:
+            logger.exception("Failure of task %s was not recorded", task_id)
+
+    def run_worker(self, poll_interval, max_poll_interval):
+        stop = threading.Event()
+
+        def request_stop(signum, frame):
+            # the task which is running is finished first
+            self.stdout.write("Stopping worker")
+            stop.set()
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        self.stdout.write("Waiting for tasks")
+        interval = poll_interval
+        while not stop.is_set():
+            # reconnect if the database closed the connection while waiting
+            close_old_connections()
+            if self.run_pending_tasks(stop):
+                interval = poll_interval
+            else:
+                # back off while the queue is empty
+                interval = min(interval * 2, max_poll_interval)
+            stop.wait(interval)
@@ -0,0 +1,101 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from obcine.models import Task
+
+DURATION_BUCKETS = [1, 5, 15, 60, 300, 900]
+
+
+def format_labels(**labels):
+    return ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+
+class Command(BaseCommand):
+    help = "Print metrics of the task queue in Prometheus text format"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--window",
+            type=int,
+            default=60,
+            help="Minutes of finished tasks included in durations and completions",
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        since = now - timedelta(minutes=options["window"])
+        statuses = Task.get_status_filters()
+
+        self.write_metric("obcine_tasks", "gauge", "Number of tasks by lane and status")
+        counts = Task.objects.values("lane").annotate(
+            **{status: Count("id", filter=q) for status, q in statuses.items()}
+        )
+        for row in counts.order_by("lane"):
+            for status in statuses:
+                labels = format_labels(lane=row["lane"], status=status)
+                self.stdout.write(f"obcine_tasks{{{labels}}} {row[status]}")
+
+        self.write_metric(
+            "obcine_task_queue_age_seconds",
+            "gauge",
+            "Age of the oldest pending task by lane",
+        )
+        oldest = (
+            Task.objects.filter(statuses["pending"])
+            .values("lane")
+            .annotate(created_at=Min("created_at"))
+        )
+        for row in oldest.order_by("lane"):
+            age = (now - row["created_at"]).total_seconds()
+            labels = format_labels(lane=row["lane"])
+            self.stdout.write(f"obcine_task_queue_age_seconds{{{labels}}} {age:.1f}")
+
+        self.write_metric(
+            "obcine_tasks_completed",
+            "gauge",
+            f"Tasks completed in the last {options['window']} minutes by status",
+        )
+        for status, field in [
+            ("finished", "finished_at"),
+            ("skipped", "skipped_at"),
+            ("failed", "errored_at"),
+        ]:
+            count = Task.objects.filter(**{f"{field}__gte": since}).count()
+            labels = format_labels(status=status)
+            self.stdout.write(f"obcine_tasks_completed{{{labels}}} {count}")
+
+        self.write_metric(
+            "obcine_task_duration_seconds",
+            "histogram",
+            f"Duration of tasks finished in the last {options['window']} minutes",
+        )
+        durations = {}
+        finished_tasks = Task.objects.filter(finished_at__gte=since).values_list(
+            "payload__parser", "started_at", "finished_at"
+        )
+        for parser, started_at, finished_at in finished_tasks:
+            duration = (finished_at - started_at).total_seconds()
+            durations.setdefault(parser, []).append(duration)
+        for parser, values in sorted(durations.items()):
+            for bucket in DURATION_BUCKETS + ["+Inf"]:
+                count = len(
+                    [value for value in values if bucket == "+Inf" or value <= bucket]
+                )
+                labels = format_labels(parser=parser, le=bucket)
+                self.stdout.write(
+                    f"obcine_task_duration_seconds_bucket{{{labels}}} {count}"
+                )
+            labels = format_labels(parser=parser)
+            self.stdout.write(
+                f"obcine_task_duration_seconds_sum{{{labels}}} {sum(values):.3f}"
+            )
+            self.stdout.write(
+                f"obcine_task_duration_seconds_count{{{labels}}} {len(values)}"
+            )
+
+    def write_metric(self, name, metric_type, help_text):
+        self.stdout.write(f"# HELP {name} {help_text}")
+        self.stdout.write(f"# TYPE {name} {metric_type}")
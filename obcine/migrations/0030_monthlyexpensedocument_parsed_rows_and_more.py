@@ -0,0 +1,55 @@
+# Generated by Django 4.0.5 on 2026-10-18 13:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("obcine", "0029_alter_municipality_slug"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="monthlyexpensedocument",
+            name="parsed_rows",
+            field=models.BinaryField(
+                blank=True, help_text="Compressed rows of the uploaded file", null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="monthlyrevenuedocument",
+            name="parsed_rows",
+            field=models.BinaryField(
+                blank=True, help_text="Compressed rows of the uploaded file", null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="plannedexpensedocument",
+            name="parsed_rows",
+            field=models.BinaryField(
+                blank=True, help_text="Compressed rows of the uploaded file", null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="plannedrevenuedocument",
+            name="parsed_rows",
+            field=models.BinaryField(
+                blank=True, help_text="Compressed rows of the uploaded file", null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="yearlyexpensedocument",
+            name="parsed_rows",
+            field=models.BinaryField(
+                blank=True, help_text="Compressed rows of the uploaded file", null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="yearlyrevenuedocument",
+            name="parsed_rows",
+            field=models.BinaryField(
+                blank=True, help_text="Compressed rows of the uploaded file", null=True
+            ),
+        ),
+    ]
@@ -0,0 +1,185 @@
+# Generated by Django 4.0.5 on 2026-10-18 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("obcine", "0030_monthlyexpensedocument_parsed_rows_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="monthlyexpensedocument",
+            name="file_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="sha256 of the file",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="monthlyexpensedocument",
+            name="imported_at",
+            field=models.DateTimeField(
+                blank=True, editable=False, null=True, verbose_name="Imported at"
+            ),
+        ),
+        migrations.AddField(
+            model_name="monthlyexpensedocument",
+            name="imported_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="sha256 of the last successfully imported file",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="monthlyrevenuedocument",
+            name="file_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="sha256 of the file",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="monthlyrevenuedocument",
+            name="imported_at",
+            field=models.DateTimeField(
+                blank=True, editable=False, null=True, verbose_name="Imported at"
+            ),
+        ),
+        migrations.AddField(
+            model_name="monthlyrevenuedocument",
+            name="imported_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="sha256 of the last successfully imported file",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="plannedexpensedocument",
+            name="file_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="sha256 of the file",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="plannedexpensedocument",
+            name="imported_at",
+            field=models.DateTimeField(
+                blank=True, editable=False, null=True, verbose_name="Imported at"
+            ),
+        ),
+        migrations.AddField(
+            model_name="plannedexpensedocument",
+            name="imported_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="sha256 of the last successfully imported file",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="plannedrevenuedocument",
+            name="file_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="sha256 of the file",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="plannedrevenuedocument",
+            name="imported_at",
+            field=models.DateTimeField(
+                blank=True, editable=False, null=True, verbose_name="Imported at"
+            ),
+        ),
+        migrations.AddField(
+            model_name="plannedrevenuedocument",
+            name="imported_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="sha256 of the last successfully imported file",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="task",
+            name="skipped_at",
+            field=models.DateTimeField(
+                blank=True,
+                default=None,
+                help_text="time when skipped because there was nothing to do",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="yearlyexpensedocument",
+            name="file_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="sha256 of the file",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="yearlyexpensedocument",
+            name="imported_at",
+            field=models.DateTimeField(
+                blank=True, editable=False, null=True, verbose_name="Imported at"
+            ),
+        ),
+        migrations.AddField(
+            model_name="yearlyexpensedocument",
+            name="imported_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="sha256 of the last successfully imported file",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="yearlyrevenuedocument",
+            name="file_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="sha256 of the file",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="yearlyrevenuedocument",
+            name="imported_at",
+            field=models.DateTimeField(
+                blank=True, editable=False, null=True, verbose_name="Imported at"
+            ),
+        ),
+        migrations.AddField(
+            model_name="yearlyrevenuedocument",
+            name="imported_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="sha256 of the last successfully imported file",
+                max_length=64,
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.0.5 on 2026-10-18 13:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("obcine", "0031_monthlyexpensedocument_file_hash_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="task",
+            name="attempts",
+            field=models.IntegerField(default=0, help_text="number of started runs"),
+        ),
+        migrations.AddField(
+            model_name="task",
+            name="run_after",
+            field=models.DateTimeField(
+                blank=True,
+                default=None,
+                help_text="time after which a failed task is retried",
+                null=True,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="task",
+            name="errored_at",
+            field=models.DateTimeField(
+                blank=True,
+                default=None,
+                help_text="time when the last attempt failed, the task is not retried",
+                null=True,
+            ),
+        ),
+    ]
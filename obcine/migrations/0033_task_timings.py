@@ -0,0 +1,22 @@
+# Generated by Django 4.0.5 on 2026-10-18 13:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("obcine", "0032_task_attempts_task_run_after_alter_task_errored_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="task",
+            name="timings",
+            field=models.JSONField(
+                blank=True,
+                default=dict,
+                help_text="duration, number of queries and rows of phases of the last run",
+            ),
+        ),
+    ]
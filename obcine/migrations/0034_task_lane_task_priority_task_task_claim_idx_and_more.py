@@ -0,0 +1,42 @@
+# Generated by Django 4.0.5 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("obcine", "0033_task_timings"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="task",
+            name="lane",
+            field=models.CharField(
+                choices=[("interactive", "Interactive"), ("backfill", "Backfill")],
+                default="interactive",
+                help_text="runners can be started for a single lane",
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="task",
+            name="priority",
+            field=models.IntegerField(
+                default=0, help_text="tasks with higher priority are run first"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="task",
+            index=models.Index(
+                fields=["lane", "-priority", "created_at"], name="task_claim_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="task",
+            index=models.Index(
+                fields=["-priority", "created_at"], name="task_priority_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.0.5 on 2026-10-18 13:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("obcine", "0034_task_lane_task_priority_task_task_claim_idx_and_more"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="task",
+            name="errored_at",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                default=None,
+                help_text="time when the last attempt failed, the task is not retried",
+                null=True,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="task",
+            name="finished_at",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                default=None,
+                help_text="time when finished",
+                null=True,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="task",
+            name="skipped_at",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                default=None,
+                help_text="time when skipped because there was nothing to do",
+                null=True,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="task",
+            name="started_at",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                default=None,
+                help_text="time when started",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.0.5 on 2026-10-18 13:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("obcine", "0035_alter_task_errored_at_alter_task_finished_at_and_more"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="task",
+            name="task_claim_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="task",
+            name="task_priority_idx",
+        ),
+        migrations.AddIndex(
+            model_name="task",
+            index=models.Index(
+                condition=models.Q(
+                    ("skipped_at__isnull", True), ("started_at__isnull", True)
+                ),
+                fields=["lane", "-priority", "created_at"],
+                name="task_claim_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="task",
+            index=models.Index(
+                condition=models.Q(
+                    ("skipped_at__isnull", True), ("started_at__isnull", True)
+                ),
+                fields=["-priority", "created_at"],
+                name="task_priority_idx",
+            ),
+        ),
+    ]
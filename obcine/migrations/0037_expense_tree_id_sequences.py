@@ -0,0 +1,38 @@
+from django.db import migrations
+
+EXPENSE_MODELS = ["PlannedExpense", "MonthlyExpense", "YearlyExpense"]
+
+
+def forwards_func(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for model_name in EXPENSE_MODELS:
+        model = apps.get_model("obcine", model_name)
+        sequence = schema_editor.quote_name(f"{model._meta.db_table}_tree_id_seq")
+        table = schema_editor.quote_name(model._meta.db_table)
+        # continue after tree ids which are already used
+        schema_editor.execute(f"CREATE SEQUENCE {sequence}")
+        schema_editor.execute(
+            f"SELECT setval('{sequence}', COALESCE(MAX(tree_id), 0) + 1, false) "
+            f"FROM {table}"
+        )
+
+
+def reverse_func(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for model_name in EXPENSE_MODELS:
+        model = apps.get_model("obcine", model_name)
+        sequence = schema_editor.quote_name(f"{model._meta.db_table}_tree_id_seq")
+        schema_editor.execute(f"DROP SEQUENCE {sequence}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("obcine", "0036_remove_task_task_claim_idx_and_more"),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards_func, reverse_func),
+    ]
@@ -1,19 +1,32 @@
+import logging
 import re
-from datetime import datetime
+import traceback
+from datetime import datetime, timedelta
 from importlib import import_module
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.contrib.contenttypes.models import ContentType
 from django.core.validators import FileExtensionValidator
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
+from django.utils import timezone
 from django.utils.text import slugify
 from django.utils.translation import gettext_lazy as _
 from martor.models import MartorField
+from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey
 
-from obcine.parse_utils import XLSXAppraBudget, XLSXAppraRevenue, download_file
+from obcine.parse_utils import (
+    XLSXAppraBudget,
+    XLSXAppraRevenue,
+    download_file,
+    get_file_hash,
+    get_tree_ids,
+    lock_tree_ids,
+    skip_used_tree_ids,
+)
+from obcine.timing_utils import PhaseTimer
 from obcine.validators import (
     document_size_validator,
     image_validator,
@@ -21,6 +34,9 @@ from obcine.validators import (
     validate_image_extension,
     validate_revenue_file,
 )
+from obcine.xlsx_utils import XLSX_ERRORS, dump_xlsx_rows, load_xlsx_rows
+
+logger = logging.getLogger(__name__)
 
 
 class Timestampable(models.Model):
@@ -37,14 +53,37 @@ class Timestampable(models.Model):
 
 
 class Task(Timestampable):
+    class Lane(models.TextChoices):
+        INTERACTIVE = "interactive", _("Interactive")
+        BACKFILL = "backfill", _("Backfill")
+
     started_at = models.DateTimeField(
-        help_text="time when started", blank=True, null=True, default=None
+        help_text="time when started",
+        blank=True,
+        null=True,
+        default=None,
+        db_index=True,
     )
     finished_at = models.DateTimeField(
-        help_text="time when finished", blank=True, null=True, default=None
+        help_text="time when finished",
+        blank=True,
+        null=True,
+        default=None,
+        db_index=True,
     )
     errored_at = models.DateTimeField(
-        help_text="time when errored", blank=True, null=True, default=None
+        help_text="time when the last attempt failed, the task is not retried",
+        blank=True,
+        null=True,
+        default=None,
+        db_index=True,
+    )
+    skipped_at = models.DateTimeField(
+        help_text="time when skipped because there was nothing to do",
+        blank=True,
+        null=True,
+        default=None,
+        db_index=True,
     )
     error_msg = models.TextField()
     name = models.TextField(blank=False, null=False, help_text="Name of task")
@@ -54,10 +93,130 @@ class Task(Timestampable):
         help_text="A message sent to the administrator when the task is complete.",
     )
     payload = models.JSONField(help_text="Payload kwargs")
+    attempts = models.IntegerField(default=0, help_text="number of started runs")
+    timings = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="duration, number of queries and rows of phases of the last run",
+    )
+    run_after = models.DateTimeField(
+        help_text="time after which a failed task is retried",
+        blank=True,
+        null=True,
+        default=None,
+    )
+    lane = models.CharField(
+        max_length=20,
+        choices=Lane.choices,
+        default=Lane.INTERACTIVE,
+        help_text="runners can be started for a single lane",
+    )
+    priority = models.IntegerField(
+        default=0, help_text="tasks with higher priority are run first"
+    )
 
-    def run(self):
-        self.started_at = datetime.now()
+    class Meta:
+        # claim query walks these indexes in order and stops at the first
+        # free task, with or without a lane. Only unstarted tasks are indexed,
+        # so the indexes stay small while the history grows.
+        indexes = [
+            models.Index(
+                fields=["lane", "-priority", "created_at"],
+                name="task_claim_idx",
+                condition=Q(started_at__isnull=True, skipped_at__isnull=True),
+            ),
+            models.Index(
+                fields=["-priority", "created_at"],
+                name="task_priority_idx",
+                condition=Q(started_at__isnull=True, skipped_at__isnull=True),
+            ),
+        ]
+
+    @classmethod
+    def get_status_filters(cls):
+        """
+        Returns filters of tasks for every status
+        """
+        now = timezone.now()
+        not_done = Q(
+            finished_at__isnull=True, skipped_at__isnull=True, errored_at__isnull=True
+        )
+        return {
+            "pending": not_done
+            & Q(started_at__isnull=True)
+            & (Q(run_after__isnull=True) | Q(run_after__lte=now)),
+            "retrying": not_done & Q(started_at__isnull=True, run_after__gt=now),
+            "running": not_done & Q(started_at__isnull=False),
+            "finished": Q(finished_at__isnull=False),
+            "skipped": Q(skipped_at__isnull=False),
+            "failed": Q(errored_at__isnull=False),
+        }
+
+    @classmethod
+    def claim(cls, lane=None):
+        """
+        Marks the pending task with the highest priority as started and
+        returns it, or None if there is nothing to run. Tasks locked by other
+        runners are skipped, so every task is claimed only once.
+        """
+        statuses = cls.get_status_filters()
+        # runner was killed before it could finish or record the error
+        abandoned = statuses["running"] & Q(
+            started_at__lt=timezone.now() - timedelta(seconds=2 * settings.TASK_TIMEOUT)
+        )
+        with transaction.atomic():
+            # pending tasks are found in the partial indexes, abandoned tasks
+            # are rare and only looked for when nothing is pending
+            for status_filter in [statuses["pending"], abandoned]:
+                tasks = cls.objects.filter(status_filter)
+                if lane:
+                    tasks = tasks.filter(lane=lane)
+                tasks = tasks.select_for_update(skip_locked=True).order_by(
+                    "-priority", "created_at"
+                )
+                while task := tasks.first():
+                    if task.started_at and task.attempts >= settings.TASK_MAX_ATTEMPTS:
+                        # killed runners never call fail(), the task would be
+                        # taken back forever
+                        task.abandon()
+                        continue
+                    task.start()
+                    return task
+        return None
+
+    def start(self):
+        self.started_at = timezone.now()
+        self.attempts += 1
+        self.save()
+
+    def abandon(self):
+        """
+        Marks the task as errored after its runner stopped on the last attempt
+        """
+        self.error_msg = (
+            f"Runner stopped without finishing the task in {self.attempts} attempts"
+        )
+        self.errored_at = timezone.now()
+        self.save()
+
+    def fail(self):
+        """
+        Stores the traceback of the current exception and schedules the next
+        attempt, or marks the task as errored after the last one
+        """
+        self.error_msg = traceback.format_exc()
+        if self.attempts < settings.TASK_MAX_ATTEMPTS:
+            delay = settings.TASK_RETRY_BACKOFF * 2 ** (self.attempts - 1)
+            self.run_after = timezone.now() + timedelta(seconds=delay)
+            self.started_at = None
+        else:
+            self.errored_at = timezone.now()
         self.save()
+
+    def run(self):
+        if not self.started_at:
+            self.start()
+        timer = PhaseTimer()
         try:
             data = self.payload
             model = data["model"]
@@ -77,26 +236,116 @@ class Task(Timestampable):
 
             if definition and definition != "None":
                 definiton_model = getattr(models_module, definition)
-                parser = parser_class(
-                    document, model=models_class, definiton_model=definiton_model
-                )
             else:
-                parser = parser_class(
-                    document, model=models_class, definiton_model=None
-                )
-            if settings.ENABLE_S3:
-                image_path = download_file(document.file.url, document.file.name)
-                parser.parse_file(file_path=image_path)
+                definiton_model = None
+            parser = parser_class(
+                document,
+                model=models_class,
+                definiton_model=definiton_model,
+                incremental=data.get("incremental", False),
+                timer=timer,
+            )
+            documents = document_class.objects.filter(id=pk)
+            # the file isn't downloaded if the stored hash shows it didn't change
+            if document.file_hash and document.file_hash == document.imported_hash:
+                self.skip(documents.filter(file_hash=document.file_hash), timer)
+                return
+
+            file_path = None
+            if not document.parsed_rows:
+                with timer.phase("download"):
+                    if settings.ENABLE_S3:
+                        file_path = download_file(document.file.url, document.file.name)
+                    else:
+                        file_path = document.file.path
+
+            # files uploaded before hashes were stored have to be hashed here
+            file_hash = document.file_hash or get_file_hash(file_path)
+            if file_hash == document.imported_hash:
+                self.skip(documents.filter(file_hash=file_hash), timer)
+                return
+
+            if document.parsed_rows:
+                # rows were read when the file was uploaded
+                parser.import_rows(load_xlsx_rows(document.parsed_rows))
             else:
-                parser.parse_file(file_path=document.file.path)
+                parser.parse_file(file_path=file_path)
+
+            # update doesn't call save, which would create a new task
+            documents.update(imported_hash=file_hash, imported_at=timezone.now())
+            documents.filter(file_hash="").update(file_hash=file_hash)
+            # rows are not needed after the import, rows of a file uploaded
+            # in the meantime are kept for its own task
+            documents.filter(file_hash=file_hash).update(parsed_rows=None)
+
+            self.finished_at = timezone.now()
+            self.save_timings(timer)
+
+        except Exception:
+            self.timings = timer.phases
+            self.fail()
+
+    def skip(self, documents, timer):
+        """
+        Marks the task as skipped, the file of the documents was already
+        imported and their rows are not needed anymore
+        """
+        documents.update(parsed_rows=None)
+        self.skipped_at = timezone.now()
+        self.save_timings(timer)
 
-            self.finished_at = datetime.now()
-            self.save()
+    def save_timings(self, timer):
+        self.timings = timer.phases
+        self.save()
+        for name, phase in timer.phases.items():
+            logger.info(
+                "task=%s document=%s pk=%s phase=%s seconds=%s queries=%s rows=%s",
+                self.id,
+                self.payload.get("self"),
+                self.payload.get("pk"),
+                name,
+                phase["seconds"],
+                phase["queries"],
+                phase["rows"],
+            )
+
+    def timings_summary(self):
+        summary = []
+        for name, phase in self.timings.items():
+            details = [f"{phase['queries']} queries"]
+            if phase["rows"] is not None:
+                details.insert(0, f"{phase['rows']} rows")
+            summary.append(f"{name} {phase['seconds']:.2f} s ({', '.join(details)})")
+        return ", ".join(summary)
+
+    timings_summary.short_description = _("Timings")
+
+    def municipality(self):
+        return self.payload.get("municipality", "")
+
+    municipality.short_description = _("Municipality")
 
-        except Exception as e:
-            self.errored_at = datetime.now()
-            self.error_msg = e
-            self.save()
+    def status(self):
+        if self.errored_at:
+            return "failed"
+        if self.skipped_at:
+            return "skipped"
+        if self.finished_at:
+            return "finished"
+        if self.started_at:
+            return "running"
+        if self.run_after and self.run_after > timezone.now():
+            return "retrying"
+        return "pending"
+
+    status.short_description = _("Status")
+
+    def duration(self):
+        if not (self.started_at and self.finished_at):
+            return "-"
+        return f"{(self.finished_at - self.started_at).total_seconds():.1f} s"
+
+    duration.short_description = _("Duration")
 
 
 class ParsableDocument(Timestampable):
@@ -116,20 +365,96 @@ class ParsableDocument(Timestampable):
             document_size_validator,
         ],
     )
+    parsed_rows = models.BinaryField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Compressed rows of the uploaded file",
+    )
+    file_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        editable=False,
+        help_text="sha256 of the file",
+    )
+    imported_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        editable=False,
+        help_text="sha256 of the last successfully imported file",
+    )
+    imported_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name=_("Imported at"),
+    )
+
+    def import_fingerprint(self):
+        if not self.imported_hash:
+            return "-"
+        return f"{self.imported_hash[:12]} ({self.imported_at:%d. %m. %Y %H:%M})"
+
+    import_fingerprint.short_description = _("Import fingerprint")
+
+    # priority of parse tasks of the document
+    task_priority = 0
 
-    def parse(self, parser, model, definition=None):
+    def save(self, *args, **kwargs):
+        if not self.file:
+            self.parsed_rows = None
+            self.file_hash = ""
+        elif not self.file._committed:
+            self.file_hash = get_file_hash(self.file)
+            # read rows while the uploaded file is still at hand, so the task
+            # doesn't have to download and read the file again
+            if settings.PARSE_ON_UPLOAD:
+                try:
+                    self.parsed_rows = dump_xlsx_rows(self.file)
+                except XLSX_ERRORS:
+                    # only the header was validated, the task reads the file
+                    # again and records the error
+                    self.parsed_rows = None
+                    self.file.seek(0)
+            else:
+                self.parsed_rows = None
+        super().save(*args, **kwargs)
+
+    def parse(self, parser, model, definition=None, incremental=False):
+        # nothing to do if the file didn't change since the last import
+        if self.file_hash and self.file_hash == self.imported_hash:
+            return
         if definition:
             definition = definition.__name__
-        Task(
+        # documents of past years are usually uploaded in bulk and shouldn't
+        # hold back uploads of the current year
+        if self.municipality_year.financial_year.is_current():
+            lane = Task.Lane.INTERACTIVE
+        else:
+            lane = Task.Lane.BACKFILL
+        task = Task(
             name="Parse xls",
+            lane=lane,
+            priority=self.task_priority,
             payload={
                 "model": f"{model.__name__}",
                 "parser": f"{parser.__name__}",
                 "definition": f"{definition}",
                 "pk": self.id,
                 "self": f"{self.__class__.__name__}",
+                "incremental": incremental,
+                "municipality": str(self.municipality_year),
             },
-        ).save()
+        )
+        task.save()
+        # tasks read the current file of the document, so pending tasks of
+        # the same document are superseded by the new one
+        Task.objects.filter(
+            started_at__isnull=True,
+            skipped_at__isnull=True,
+            payload__self=task.payload["self"],
+            payload__pk=task.payload["pk"],
+        ).exclude(id=task.id).update(skipped_at=timezone.now())
         # parser = parser(self, model, definition)
         # if settings.ENABLE_S3:
         #     image_path = download_file(self.file.url, self.file.name)
@@ -367,7 +692,7 @@ class FinancialCategory(MPTTModel):
 ## Revenue
 
 
-class RevenueDefinition(MPTTModel):
+class RevenueDefinition(MPTTModel, Timestampable):
     parent = TreeForeignKey(
         "self",
         on_delete=models.CASCADE,
@@ -508,16 +833,21 @@ class MonthlyRevenueDocument(RevenueParsableDocument):
         verbose_name=_("Datum obdelave podatkov"), null=True, blank=True
     )
 
+    # monthly updates are small and should be visible soon
+    task_priority = 10
+
     def __str__(self):
         return f"{self.municipality_year.financial_year.name}"
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         if self.file:
+            # monthly realizations mostly repeat rows of the previous month
             self.parse(
                 parser=XLSXAppraRevenue,
                 model=MonthlyRevenue,
                 definition=RevenueDefinition,
+                incremental=True,
             )
 
     class Meta:
@@ -535,6 +865,20 @@ class ExpenseDefinition(FinancialCategory):
         verbose_name_plural = _("Revenue definitions")
 
 
+class ExpenseManager(TreeManager):
+    def _get_next_tree_id(self):
+        # trees added in the admin take ids from the sequence used by imports
+        return get_tree_ids(self.model, 1)[0]
+
+    def _create_tree_space(self, target_tree_id, num_trees=1):
+        # roots ordered by order_insertion_by are inserted between trees, all
+        # following trees are shifted and the largest tree id grows
+        with transaction.atomic():
+            lock_tree_ids(self.model, shared=False)
+            super()._create_tree_space(target_tree_id, num_trees)
+            skip_used_tree_ids(self.model)
+
+
 class Expense(FinancialCategory):
     municipality = models.ForeignKey(
         "Municipality",
@@ -551,6 +895,8 @@ class Expense(FinancialCategory):
         verbose_name=_("Year"),
     )
 
+    objects = ExpenseManager()
+
     class Meta:
         abstract = True
 
@@ -607,15 +953,20 @@ class MonthlyExpenseDocument(ExpenseParsableDocument):
         verbose_name=_("Datum obdelave podatkov"), null=True, blank=True
     )
 
+    # monthly updates are small and should be visible soon
+    task_priority = 10
+
     def __str__(self):
         return f"{self.municipality_year.financial_year.name}"
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         if self.file:
+            # monthly realizations mostly repeat rows of the previous month
             self.parse(
                 parser=XLSXAppraBudget,
                 model=MonthlyExpense,
+                incremental=True,
             )
 
     class Meta:
@@ -1,17 +1,124 @@
-import time
+import hashlib
+import os
+import tempfile
+import zlib
+from decimal import Decimal
 
 import requests
-import xlrd
-from django.db import transaction
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from obcine.timing_utils import PhaseTimer
+from obcine.xlsx_utils import iter_xlsx_rows
+
+BATCH_SIZE = 1000
+
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# reuse connections to the storage between downloads
+session = requests.Session()
+
+# columns of APPRA exports used by parsers
+BUDGET_COLUMNS = {2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 16}
+REVENUE_COLUMNS = {1, 2, 3}
+
+# fields of expense nodes which are compared and written by incremental import
+EXPENSE_UPDATE_FIELDS = ["name", "order", "amount", "tree_id", "lft", "rght", "level"]
+
+
+def to_decimal(value):
+    """
+    Rounds xlsx float value to the precision of amount fields
+    """
+    return Decimal(str(value)).quantize(Decimal("0.01"))
+
+
+def lock_import(model, municipality, year):
+    """
+    Waits until other imports into the same rows of the model commit and
+    holds the lock until the end of the transaction. Concurrent imports of
+    the same document would otherwise miss each other's rows when deleting.
+    Imports of other municipalities and years don't wait.
+    """
+    if connection.vendor != "postgresql":
+        return
+    key = f"{model._meta.db_table}:{municipality.id}:{year.id}"
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [zlib.crc32(key.encode())])
+
+
+def get_tree_id_sequence(model):
+    return f"{model._meta.db_table}_tree_id_seq"
+
+
+def lock_tree_ids(model, shared=True):
+    """
+    Imports hold the shared lock while their tree ids are not committed yet,
+    they don't wait for each other. Shifting tree ids takes the lock
+    exclusively, so shifted trees never take ids handed out to an import.
+    The lock is held until the end of the transaction.
+    """
+    if connection.vendor != "postgresql":
+        return
+    key = f"{model._meta.db_table}:tree_id"
+    function = "pg_advisory_xact_lock_shared" if shared else "pg_advisory_xact_lock"
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {function}(%s)", [zlib.crc32(key.encode())])
+
+
+def get_tree_ids(model, count):
+    """
+    Returns count unused tree ids in increasing order. Tree ids are shared
+    between all municipalities and years, on PostgreSQL they come from a
+    sequence, so concurrent imports never get the same ids. Other databases
+    serialize writes, ids after the largest saved one are used there.
+    """
+    if connection.vendor != "postgresql":
+        max_tree_id = model.objects.aggregate(max_tree_id=Max("tree_id"))
+        max_tree_id = max_tree_id["max_tree_id"] or 0
+        return list(range(max_tree_id + 1, max_tree_id + 1 + count))
+    lock_tree_ids(model)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(%s) FROM generate_series(1, %s)",
+            [get_tree_id_sequence(model), count],
+        )
+        return sorted([row[0] for row in cursor.fetchall()])
+
+
+def skip_used_tree_ids(model):
+    """
+    Moves the tree id sequence past the largest saved tree id, trees shifted
+    by mptt can take ids after the last one handed out by the sequence
+    """
+    if connection.vendor != "postgresql":
+        return
+    quote_name = connection.ops.quote_name
+    sequence = get_tree_id_sequence(model)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT setval(%s, GREATEST("
+            f"(SELECT COALESCE(MAX(tree_id), 0) FROM {quote_name(model._meta.db_table)}), "
+            f"(SELECT last_value FROM {quote_name(sequence)})))",
+            [sequence],
+        )
 
 
 class XLSXAppraBudget(object):
-    def __init__(self, document, model, definiton_model=None):
+    def __init__(
+        self, document, model, definiton_model=None, incremental=False, timer=None
+    ):
         self.municipality = document.municipality_year.municipality
         self.year = document.municipality_year.financial_year
         self.model = model
         self.document_object = document
         self.municipality_year = document.municipality_year
+        self.incremental = incremental
+        self.timer = timer or PhaseTimer()
 
     def prepare_moodel(self, name, code, order):
         obj = self.model(
@@ -25,170 +132,248 @@ class XLSXAppraBudget(object):
         )
         return obj
 
-    def parse_file(self, file_path="files/proracun_apra.xlsx"):
-        book = xlrd.open_workbook(file_path)
-        sheet = book.sheet_by_index(0)
+    def add_node(self, parent, name, code, order):
+        node = self.prepare_moodel(name=name, code=code, order=order)
+        node.parent = parent
+        node.amount = Decimal(0)
+        node.child_nodes = []
+        if parent:
+            parent.child_nodes.append(node)
+        return node
+
+    def set_tree_fields(self, node, levels, tree_id, level, lft):
+        """
+        Sets mptt fields of node and its subtree and collects the nodes by
+        level. Returns rght of the node.
+        """
+        levels.setdefault(level, []).append(node)
+        node.tree_id = tree_id
+        node.level = level
+        node.lft = lft
+        rght = lft + 1
+        for child in node.child_nodes:
+            rght = self.set_tree_fields(child, levels, tree_id, level + 1, rght) + 1
+        node.rght = rght
+        return rght
 
-        # delete previous data
-        self.model.objects.filter(
-            year=self.year, municipality=self.municipality
-        ).delete()
-
-        nodes = {}
-        node_keys = []
-        i = 0
-        print(range(sheet.nrows))
-        start_time = time.time()
-        for row_i in range(sheet.nrows):
+    def parse_file(self, file_path="files/proracun_apra.xlsx"):
+        with self.timer.phase("open"):
+            rows = iter_xlsx_rows(file_path, columns=BUDGET_COLUMNS)
             # skip first row
-            if i == 0:
-                i += 1
-                continue
-
-            # get first level data and save it
-            row = sheet.row(row_i)
-            ppp_id = row[2].value.strip()
-            ppp_name = row[3].value.strip()
-
-            if ppp_id in node_keys:
-                ppp = nodes[ppp_id]
-            else:
-                ppp = self.prepare_moodel(
-                    name=ppp_name,
-                    code=ppp_id,
-                    order=i,
-                )
-                ppp.save()
-                i += 1
-                nodes[ppp_id] = ppp
-                node_keys.append(ppp_id)
-
-            # get second level data and save it
-            gpr_id = row[4].value.strip()
-            gpr_name = row[5].value.strip()
-
-            if gpr_id in node_keys:
-                gpr = nodes[gpr_id]
-            else:
-                gpr = self.prepare_moodel(
-                    name=gpr_name,
-                    code=gpr_id,
-                    order=i,
-                )
-                gpr.parent = ppp
-                gpr.save()
-                i += 1
-                nodes[gpr_id] = gpr
-                node_keys.append(gpr_id)
-
-            # get third level data and save it, or update amount on existed
-            ppr_id = row[6].value.strip()
-            ppr_name = row[7].value.strip()
-
-            amount = row[16].value
-
-            if ppr_id in node_keys:
-                ppr = nodes[ppr_id]
-                # ppr.amount += amount
-                # ppr.save()
+            next(rows, None)
+        return self.import_rows(rows)
+
+    def import_rows(self, rows):
+        """
+        Builds the expense tree from rows of APPRA export and saves it.
+        Returns numbers of inserted, updated and deleted nodes.
+        """
+        with self.timer.phase("read") as phase:
+            roots, nodes, phase["rows"] = self.read_rows(rows)
+
+        with self.timer.phase("roll-up") as phase:
+            # parents are added before their children, in reversed order all
+            # descendants of a node are summed before the node itself
+            for node in reversed(nodes.values()):
+                if node.parent:
+                    node.parent.amount += node.amount
+            phase["rows"] = len(nodes)
+
+        # readers see the previous tree until the new one is committed
+        with transaction.atomic():
+            if self.incremental:
+                delta = self.update_nodes(roots, nodes)
             else:
-                ppr = self.prepare_moodel(
-                    name=ppr_name,
-                    code=ppr_id,
-                    order=i,
-                )
-                ppr.parent = gpr
-                # ppr.amount=amount
-                ppr.save()
-                i += 1
-                nodes[ppr_id] = ppr
-                node_keys.append(ppr_id)
-
-            # Do tuki je ok
-
-            pp_id = f"fk{row[8].value.strip()}"
-            pp_name = row[9].value.strip()
-            ppr_pp_id = f"{ppr_id}_{pp_id}"
-
-            if ppr_pp_id in node_keys:
-                pp = nodes[ppr_pp_id]
-            else:
-                pp = self.prepare_moodel(
-                    name=pp_name,
-                    code=pp_id,
-                    order=i,
-                )
-                pp.parent = ppr
-                pp.save()
-                i += 1
-                nodes[ppr_pp_id] = pp
-                node_keys.append(ppr_pp_id)
-
-            k4_id = row[10].value.strip()
-            k4_name = row[11].value.strip()
-            amount = row[16].value
-            ppr_pp_k4_id = f"{ppr_pp_id}_{k4_id}"
-
-            if ppr_pp_k4_id in node_keys:
-                k4 = nodes[ppr_pp_k4_id]
-            else:
-                k4 = self.prepare_moodel(
-                    name=k4_name,
-                    code=k4_id,
-                    order=i,
-                )
-
-                k4.parent = pp
-                k4.amount = amount
-                k4.save()
-                i += 1
-                nodes[k4_id] = k4
-                node_keys.append(k4_id)
-
-        for budget_item in self.model.objects.filter(
-            document=self.document_object, level=3, amount=None
-        ):
-            budget_item.amount = sum(
-                [item.amount for item in budget_item.get_children()]
+                delta = self.save_nodes(roots, nodes)
+
+            # cache keys depend on the year, saving it in the same transaction
+            # switches cached trees together with the data. Unchanged data
+            # keeps cached trees valid.
+            if any(delta.values()):
+                with self.timer.phase("invalidate cache"):
+                    self.municipality_year.save()
+        return delta
+
+    def read_rows(self, rows):
+        """
+        Builds the expense tree with amounts on leaves, returns roots, nodes
+        indexed by the codes on the path from the root and number of rows
+        """
+        roots = []
+        nodes = {}
+        order = 1
+        row_count = 0
+        for row in rows:
+            row_count += 1
+            ppp_id = row[2].strip()
+            gpr_id = row[4].strip()
+            ppr_id = row[6].strip()
+            pp_id = f"fk{row[8].strip()}"
+            k4_id = row[10].strip()
+
+            path = [
+                (ppp_id, row[3].strip()),
+                (gpr_id, row[5].strip()),
+                (ppr_id, row[7].strip()),
+                (pp_id, row[9].strip()),
+                (k4_id, row[11].strip()),
+            ]
+
+            key = ()
+            node = None
+            for code, name in path:
+                key = key + (code,)
+                if key in nodes:
+                    node = nodes[key]
+                else:
+                    node = self.add_node(node, name=name, code=code, order=order)
+                    order += 1
+                    nodes[key] = node
+                    if not node.parent:
+                        roots.append(node)
+
+            # repeated k4 rows are summed into the same node
+            node.amount += to_decimal(row[16])
+
+        return roots, nodes, row_count
+
+    def save_nodes(self, roots, nodes):
+        """
+        Replaces saved nodes with the new ones, runs in the transaction of
+        import_rows
+        """
+        with self.timer.phase("delete") as phase:
+            lock_import(self.model, self.municipality, self.year)
+
+            # delete previous data
+            deleted, _ = self.model.objects.filter(
+                year=self.year, municipality=self.municipality
+            ).delete()
+            phase["rows"] = deleted
+
+        with self.timer.phase("insert") as phase:
+            levels = {}
+            tree_ids = get_tree_ids(self.model, len(roots))
+            for root, tree_id in zip(roots, tree_ids):
+                self.set_tree_fields(root, levels, tree_id=tree_id, level=0, lft=1)
+
+            # parents have to be inserted first so children get parent ids
+            for level in sorted(levels.keys()):
+                self.model.objects.bulk_create(levels[level], batch_size=BATCH_SIZE)
+            phase["rows"] = len(nodes)
+
+        return {"inserted": len(nodes), "updated": 0, "deleted": deleted}
+
+    def get_saved_nodes(self):
+        """
+        Returns saved nodes indexed by the codes on the path from the root and
+        a list of nodes which can't be matched, e.g. duplicated paths
+        """
+        saved_nodes = {}
+        stale_nodes = []
+        paths = {}
+        queryset = self.model.objects.filter(
+            year=self.year, municipality=self.municipality
+        ).order_by("level", "tree_id", "lft")
+        for node in queryset:
+            if node.parent_id and node.parent_id not in paths:
+                stale_nodes.append(node)
+                continue
+            path = paths.get(node.parent_id, ()) + (node.code,)
+            if path in saved_nodes:
+                stale_nodes.append(node)
+                continue
+            paths[node.id] = path
+            saved_nodes[path] = node
+        return saved_nodes, stale_nodes
+
+    def update_nodes(self, roots, nodes):
+        """
+        Writes only the difference between the saved and the new tree. Nodes
+        are matched by the codes on the path from the root, matched nodes are
+        updated if anything changed, new nodes are inserted and the rest is
+        deleted.
+        """
+        with self.timer.phase("compare") as phase:
+            lock_import(self.model, self.municipality, self.year)
+            saved_nodes, stale_nodes = self.get_saved_nodes()
+
+            # tree ids of saved roots are reused and handed out in the order
+            # of the sheet, trees are listed by tree id
+            saved_tree_ids = [
+                saved_nodes[(root.code,)].tree_id
+                for root in roots
+                if (root.code,) in saved_nodes
+            ]
+            tree_ids = sorted(
+                saved_tree_ids
+                + get_tree_ids(self.model, len(roots) - len(saved_tree_ids))
             )
-            budget_item.save()
 
-        for budget_item in self.model.objects.filter(
-            document=self.document_object, level=2, amount=None
-        ):
-            budget_item.amount = sum(
-                [item.amount for item in budget_item.get_children()]
+            levels = {}
+            for root, tree_id in zip(roots, tree_ids):
+                self.set_tree_fields(root, levels, tree_id=tree_id, level=0, lft=1)
+
+            new_levels = {}
+            updated_nodes = []
+            # parents are added to nodes before their children, so parent
+            # ids are already known when children are compared
+            for key, node in nodes.items():
+                saved = saved_nodes.pop(key, None)
+                if not saved:
+                    new_levels.setdefault(node.level, []).append(node)
+                    continue
+                node.pk = saved.pk
+
+                parent_id = node.parent.pk if node.parent else None
+                changed = saved.parent_id != parent_id
+                for field in EXPENSE_UPDATE_FIELDS:
+                    if getattr(saved, field) != getattr(node, field):
+                        setattr(saved, field, getattr(node, field))
+                        changed = True
+                if changed:
+                    saved.parent_id = parent_id
+                    updated_nodes.append(saved)
+            phase["rows"] = len(nodes)
+
+        with self.timer.phase("delete") as phase:
+            # children of deleted nodes are deleted too, they can't be
+            # matched
+            deleted_ids = [node.id for node in stale_nodes]
+            deleted_ids += [node.id for node in saved_nodes.values()]
+            self.model.objects.filter(id__in=deleted_ids).delete()
+            phase["rows"] = len(deleted_ids)
+
+        with self.timer.phase("update") as phase:
+            self.model.objects.bulk_update(
+                updated_nodes,
+                EXPENSE_UPDATE_FIELDS + ["parent"],
+                batch_size=BATCH_SIZE,
             )
-            budget_item.save()
+            phase["rows"] = len(updated_nodes)
 
-        for budget_item in self.model.objects.filter(
-            document=self.document_object, level=1, amount=None
-        ):
-            budget_item.amount = sum(
-                [item.amount for item in budget_item.get_children()]
-            )
-            budget_item.save()
+        with self.timer.phase("insert") as phase:
+            for level in sorted(new_levels.keys()):
+                self.model.objects.bulk_create(new_levels[level], batch_size=BATCH_SIZE)
+            phase["rows"] = sum([len(level) for level in new_levels.values()])
 
-        for budget_item in self.model.objects.filter(
-            document=self.document_object, level=0, amount=None
-        ):
-            budget_item.amount = sum(
-                [item.amount for item in budget_item.get_children()]
-            )
-            budget_item.save()
-
-        self.municipality_year.save()
-        print("--- %s seconds ---" % (time.time() - start_time))
+        return {
+            "inserted": sum([len(level) for level in new_levels.values()]),
+            "updated": len(updated_nodes),
+            "deleted": len(deleted_ids),
+        }
 
 
 class XLSXAppraRevenue(object):
-    def __init__(self, document, model, definiton_model):
+    def __init__(self, document, model, definiton_model, incremental=False, timer=None):
         self.municipality = document.municipality_year.municipality
         self.year = document.municipality_year.financial_year
         self.municipality_year = document.municipality_year
         self.model = model
         self.document_object = document
         self.definiton_model = definiton_model
+        self.incremental = incremental
+        self.timer = timer or PhaseTimer()
         definitons_qeryset = definiton_model.objects.all()
         self.definitons = {d.code: d for d in definitons_qeryset}
 
@@ -206,35 +391,124 @@ class XLSXAppraRevenue(object):
         return obj
 
     def parse_file(self, file_path="files/proracun_apra.xlsx"):
-
-        # delete previous data
-        self.model.objects.filter(
-            year=self.year, municipality=self.municipality
-        ).delete()
-
-        book = xlrd.open_workbook(file_path)
-        sheet = book.sheet_by_index(0)
-
-        nodes = {}
-        i = 0
-        for row_i in range(sheet.nrows):
+        with self.timer.phase("open"):
+            rows = iter_xlsx_rows(file_path, columns=REVENUE_COLUMNS)
             # skip first row
-            if i == 0:
-                i += 1
-                continue
-
-            # get first level data and save it
-            row = sheet.row(row_i)
-            k6_id = row[1].value.strip()
-            k6_name = row[2].value.strip()
-            k6_amount = row[3].value
+            next(rows, None)
+        return self.import_rows(rows)
+
+    def import_rows(self, rows):
+        """
+        Saves K6 rows of APPRA export. Returns numbers of inserted, updated and
+        deleted rows.
+        """
+        with self.timer.phase("read") as phase:
+            revenues = []
+            for row in rows:
+                k6_id = row[1].strip()
+                k6_name = row[2].strip()
+                k6_amount = row[3]
+                revenues.append(
+                    self.prepare_moodel(name=k6_name, code=k6_id, amount=k6_amount)
+                )
+            phase["rows"] = len(revenues)
 
-            print(k6_id, k6_name, k6_amount)
+        # readers see the previous rows until the new ones are committed
+        with transaction.atomic():
+            if self.incremental:
+                delta = self.update_revenues(revenues)
+            else:
+                delta = self.save_revenues(revenues)
+
+            # cache keys depend on the year, saving it in the same transaction
+            # switches cached trees together with the data. Unchanged data
+            # keeps cached trees valid.
+            if any(delta.values()):
+                with self.timer.phase("invalidate cache"):
+                    self.municipality_year.save()
+        return delta
+
+    def save_revenues(self, revenues):
+        """
+        Replaces saved rows with the new ones, runs in the transaction of
+        import_rows
+        """
+        with self.timer.phase("delete") as phase:
+            lock_import(self.model, self.municipality, self.year)
+
+            # delete previous data
+            deleted, _ = self.model.objects.filter(
+                year=self.year, municipality=self.municipality
+            ).delete()
+            phase["rows"] = deleted
+
+        with self.timer.phase("insert") as phase:
+            self.model.objects.bulk_create(revenues, batch_size=BATCH_SIZE)
+            phase["rows"] = len(revenues)
+
+        return {"inserted": len(revenues), "updated": 0, "deleted": deleted}
+
+    def update_revenues(self, revenues):
+        """
+        Writes only the difference between saved and new rows. Rows are
+        matched by code, rows with the same code are matched in order.
+        """
+        with self.timer.phase("compare") as phase:
+            lock_import(self.model, self.municipality, self.year)
+            saved_revenues = {}
+            for revenue in self.model.objects.filter(
+                year=self.year, municipality=self.municipality
+            ).order_by("id"):
+                saved_revenues.setdefault(revenue.code, []).append(revenue)
+
+            new_revenues = []
+            updated_revenues = []
+            now = timezone.now()
+            for revenue in revenues:
+                if not saved_revenues.get(revenue.code):
+                    new_revenues.append(revenue)
+                    continue
+                saved = saved_revenues[revenue.code].pop(0)
+
+                amount = to_decimal(revenue.amount)
+                if (saved.name, saved.amount, saved.definition_id) != (
+                    revenue.name,
+                    amount,
+                    revenue.definition_id,
+                ):
+                    saved.name = revenue.name
+                    saved.amount = amount
+                    saved.definition_id = revenue.definition_id
+                    saved.updated_at = now
+                    updated_revenues.append(saved)
+            phase["rows"] = len(revenues)
+
+        with self.timer.phase("delete") as phase:
+            deleted_ids = [
+                revenue.id
+                for same_code_revenues in saved_revenues.values()
+                for revenue in same_code_revenues
+            ]
+            self.model.objects.filter(id__in=deleted_ids).delete()
+            phase["rows"] = len(deleted_ids)
+
+        with self.timer.phase("update") as phase:
+            self.model.objects.bulk_update(
+                updated_revenues,
+                ["name", "amount", "definition", "updated_at"],
+                batch_size=BATCH_SIZE,
+            )
+            phase["rows"] = len(updated_revenues)
 
-            k6 = self.prepare_moodel(name=k6_name, code=k6_id, amount=k6_amount)
-            k6.save()
+        with self.timer.phase("insert") as phase:
+            self.model.objects.bulk_create(new_revenues, batch_size=BATCH_SIZE)
+            phase["rows"] = len(new_revenues)
 
-        self.municipality_year.save()
+        return {
+            "inserted": len(new_revenues),
+            "updated": len(updated_revenues),
+            "deleted": len(deleted_ids),
+        }
 
 
 # class XLSParser(object):
@@ -314,22 +588,12 @@ class XLSCodesParser(object):
         return current
 
     def parse_file(self, file_path="files/kode_matic.xlsx"):
-        book = xlrd.open_workbook(file_path)
-        sheet = book.sheet_by_index(2)
-
-        rows = []
-        for row_i in range(sheet.nrows):
-            row_values = []
-            for cell in sheet.row(row_i):
-                row_values.append(cell.value)
-            rows.append(row_values)
-
         parent = None
 
         last_added = None
 
         i = 0
-        for row in rows:
+        for row in iter_xlsx_rows(file_path, sheet_index=2):
             items = self.parse_line(row)
             if len(items) != 2:
                 continue
@@ -348,9 +612,88 @@ class XLSCodesParser(object):
             i += 1
 
 
+def get_file_hash(file):
+    """
+    Returns sha256 of a django File or of a file at path
+    """
+    if isinstance(file, str):
+        with open(file, "rb") as f:
+            return get_file_hash(File(f))
+
+    content_hash = hashlib.sha256()
+    for chunk in file.chunks():
+        content_hash.update(chunk)
+    file.seek(0)
+    return content_hash.hexdigest()
+
+
+def get_cached_file_path(key, name):
+    extension = os.path.splitext(name)[1]
+    return os.path.join(settings.DOWNLOAD_CACHE_DIR, f"{key}{extension}")
+
+
+def evict_download_cache(keep):
+    """
+    Removes least recently used files when the cache is bigger than allowed,
+    the file at path keep is never removed
+    """
+    files = []
+    for entry in os.scandir(settings.DOWNLOAD_CACHE_DIR):
+        # skip files which are still being downloaded
+        if entry.is_file() and not entry.name.startswith("download-"):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    cache_size = sum([size for mtime, size, path in files])
+    for mtime, size, path in sorted(files):
+        if cache_size <= settings.DOWNLOAD_CACHE_MAX_SIZE:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+
+
 def download_file(url, name):
-    response = requests.get(url)
-    file_path = f"media/{name}"
-    with open(file_path, "wb") as f:
-        f.write(response.content)
+    """
+    Streams the file to the local cache and returns its path. Files are cached
+    by the ETag of the stored object, so the same document is downloaded only
+    once. Without an ETag the file is stored under the hash of its content.
+    """
+    os.makedirs(settings.DOWNLOAD_CACHE_DIR, exist_ok=True)
+
+    etag = None
+    response = session.head(url, timeout=DOWNLOAD_TIMEOUT)
+    if response.ok:
+        etag = response.headers.get("ETag")
+    if etag:
+        file_path = get_cached_file_path(
+            hashlib.sha256(etag.encode()).hexdigest(), name
+        )
+        if os.path.exists(file_path):
+            # mark the file as recently used
+            os.utime(file_path)
+            return file_path
+
+    content_hash = hashlib.sha256()
+    f = tempfile.NamedTemporaryFile(
+        dir=settings.DOWNLOAD_CACHE_DIR, prefix="download-", delete=False
+    )
+    try:
+        with f, session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                content_hash.update(chunk)
+        if not etag:
+            file_path = get_cached_file_path(content_hash.hexdigest(), name)
+        os.replace(f.name, file_path)
+    except Exception:
+        os.remove(f.name)
+        raise
+
+    evict_download_cache(keep=file_path)
     return file_path
@@ -1,3 +1,752 @@
-from django.test import TestCase
+import hashlib
+import http.server
+import io
+import os
+import random
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from obcine.models import (
+    FinancialYear,
+    MonthlyExpense,
+    MonthlyRevenue,
+    Municipality,
+    PlannedExpense,
+    RevenueDefinition,
+    Task,
+)
+from obcine.parse_utils import (
+    BUDGET_COLUMNS,
+    REVENUE_COLUMNS,
+    XLSXAppraBudget,
+    XLSXAppraRevenue,
+    download_file,
+)
+from obcine.tree_utils import build_merged_tree, build_tree
+from obcine.validators import get_header
+from obcine.xlsx_utils import dump_xlsx_rows, iter_xlsx_rows, load_xlsx_rows
+
+BUDGET_HEADER = [
+    "PU_ID",
+    "PU_OPIS",
+    "PPP_ID",
+    "PPP_OPIS",
+    "GPR_ID",
+    "GPR_OPIS",
+    "PPR_ID",
+    "PPR_OPIS",
+    "PP_ID",
+    "PP_OPIS",
+    "K4_ID",
+    "K4_OPIS",
+    "BLC_ID",
+    "BLC_OPIS",
+    "F1",
+    "F2",
+    "F3",
+]
+
+
+def create_municipality_year(name, year="2022"):
+    """
+    Returns the year of a new municipality, signals create its documents
+    """
+    financial_year, _ = FinancialYear.objects.get_or_create(
+        name=year, start_date=date(int(year), 1, 1), end_date=date(int(year), 12, 31)
+    )
+    municipality = Municipality.objects.create(name=name)
+    return municipality.municipalityfinancialyears.get(financial_year=financial_year)
+
+
+def get_random_definitions(rng, node_count):
+    """
+    Returns definitions of a random forest, leaves are on different levels
+    """
+    definitions = {}
+    for id in range(1, node_count + 1):
+        parent_id = rng.choice([None, *definitions.keys()])
+        definitions[id] = SimpleNamespace(
+            id=id, name=f"Node {id}", code=str(id), parent_id=parent_id
+        )
+    return definitions
+
+
+def get_random_items(rng, definitions, amount_keys):
+    parent_ids = {definition.parent_id for definition in definitions.values()}
+    leaves = [id for id in definitions if id not in parent_ids]
+    items = []
+    for id in rng.sample(leaves, rng.randint(1, len(leaves))):
+        item = {
+            "name": definitions[id].name,
+            "code": definitions[id].code,
+            "children": [],
+            "parent_id": definitions[id].parent_id,
+        }
+        for key in amount_keys:
+            item[key] = Decimal(rng.randint(0, 100000)) / 100
+        items.append(item)
+    return items
+
+
+def iter_nodes(nodes, parent=None):
+    for node in nodes:
+        yield parent, node
+        yield from iter_nodes(node["children"], node)
+
+
+class BuildTreeTest(SimpleTestCase):
+    """
+    Checks properties of trees built from random forests
+    """
+
+    tree_count = 500
+    max_nodes = 50
+
+    def check_random_trees(self, build, amount_keys):
+        for seed in range(self.tree_count):
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                definitions = get_random_definitions(
+                    rng, rng.randint(1, self.max_nodes)
+                )
+                items = get_random_items(rng, definitions, amount_keys)
+                roots = build(definitions, items)
+                self.check_tree(roots, items, amount_keys)
+
+    def check_tree(self, roots, items, amount_keys):
+        leaves = [node for parent, node in iter_nodes(roots) if not node["children"]]
+        self.assertCountEqual(map(id, leaves), map(id, items))
+
+        for parent, node in iter_nodes(roots):
+            expected_parent_id = int(parent["code"]) if parent else None
+            self.assertEqual(node["parent_id"], expected_parent_id)
+            if node["children"]:
+                for key in amount_keys:
+                    self.assertEqual(
+                        node[key], sum([child[key] for child in node["children"]])
+                    )
+
+        for key in amount_keys:
+            self.assertEqual(
+                sum([root[key] for root in roots]), sum([item[key] for item in items])
+            )
+
+    def test_build_tree(self):
+        self.check_random_trees(build_tree, ["amount"])
+
+    def test_build_merged_tree(self):
+        self.check_random_trees(build_merged_tree, ["planned", "realized"])
+
+
+def get_zip_file(files, corrupted=None):
+    """
+    Returns an uploaded zip of files, compressed data of the corrupted member
+    starts with an invalid deflate block
+    """
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for name, data in files.items():
+            zip_file.writestr(name, data)
+    content = content.getvalue()
+    if corrupted:
+        info = zipfile.ZipFile(io.BytesIO(content)).getinfo(corrupted)
+        offset = info.header_offset + 30 + len(info.filename) + len(info.extra)
+        content = content[:offset] + b"\x07" + content[offset + 1 :]
+    return SimpleUploadedFile("document.xlsx", content)
+
+
+def get_sample_files(path):
+    with zipfile.ZipFile(path) as zip_file:
+        return {name: zip_file.read(name) for name in zip_file.namelist()}
+
+
+class XLSXRowsTest(SimpleTestCase):
+    """
+    Compares rows read from the sample files to the rows xlrd returned
+    """
+
+    def test_budget_rows(self):
+        rows = list(iter_xlsx_rows("files/proracun_apra.xlsx"))
+        self.assertEqual(len(rows), 954)
+        self.assertEqual(rows[0], BUDGET_HEADER)
+        self.assertEqual(
+            rows[1],
+            [
+                "7500",
+                "občinska uprava",
+                "01",
+                "POLITIČNI SISTEM",
+                "0101",
+                "Politični sistem",
+                "01019002",
+                "Izvedba in nadzor volitev in referendumov",
+                "01007",
+                "Stroški izvedbe volitev in referendumov".ljust(150),
+                "4029",
+                "Drugi operativni odhodki",
+                "A",
+                "Bilanca odhodkov",
+                0.0,
+                0.0,
+                80000.0,
+            ],
+        )
+        self.assertEqual(
+            rows[-1][8:],
+            [
+                "15062",
+                "čistilna akcija KS Plače",
+                "4029",
+                "Drugi operativni odhodki",
+                "A",
+                "Bilanca odhodkov",
+                0.0,
+                0.0,
+                100.0,
+            ],
+        )
+
+    def test_revenue_rows(self):
+        rows = list(iter_xlsx_rows("files/prihodki_apra.xlsx"))
+        self.assertEqual(len(rows), 55)
+        self.assertEqual(rows[0], ["BLC_ID", "K6_ID", "K6_OPIS", "VREDNOST_PRI"])
+        self.assertEqual(
+            rows[1], ["0", "700020", "Dohodnina - občinski vir", 8685145.0]
+        )
+        self.assertEqual(
+            rows[-1],
+            [
+                "0",
+                "787000",
+                "Prejeta sredstva od drugih evropskih institucij",
+                44792.98,
+            ],
+        )
+
+    def test_sheet_index_and_max_rows(self):
+        rows = list(iter_xlsx_rows("files/kode_matic.xlsx", sheet_index=2, max_rows=3))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[2], ["", 70.0, "DAVČNI PRIHODKI", "", "", "", "", "", ""])
+
+    def test_columns(self):
+        rows = list(
+            iter_xlsx_rows("files/proracun_apra.xlsx", columns={2, 10, 16}, max_rows=2)
+        )
+        empty = [""] * 17
+        self.assertEqual(
+            rows,
+            [
+                [*empty[:2], "PPP_ID", *empty[3:10], "K4_ID", *empty[11:16], "F3"],
+                [*empty[:2], "01", *empty[3:10], "4029", *empty[11:16], 80000.0],
+            ],
+        )
+
+    def test_dump_rows(self):
+        for path in ["files/proracun_apra.xlsx", "files/prihodki_apra.xlsx"]:
+            with self.subTest(path=path):
+                rows = list(iter_xlsx_rows(path))
+                with open(path, "rb") as f:
+                    data = dump_xlsx_rows(f)
+                    self.assertEqual(f.tell(), 0)
+                self.assertEqual(load_xlsx_rows(data), rows[1:])
+
+
+class GetHeaderTest(SimpleTestCase):
+    def test_header(self):
+        with open("files/proracun_apra.xlsx", "rb") as f:
+            self.assertEqual(get_header(f), BUDGET_HEADER)
+
+    def test_invalid_files(self):
+        rels = (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/'
+            'relationships"></Relationships>'
+        )
+        sample = get_sample_files("files/prihodki_apra.xlsx")
+        sheet = sample["xl/worksheets/sheet1.xml"]
+        for name, files, corrupted in [
+            ("no parts", {}, None),
+            ("broken rels", {"xl/_rels/workbook.xml.rels": "<Relationships"}, None),
+            (
+                "no sheets",
+                {"xl/_rels/workbook.xml.rels": rels, "xl/workbook.xml": "<workbook/>"},
+                None,
+            ),
+            ("corrupted deflate data", sample, "xl/worksheets/sheet1.xml"),
+            (
+                "shared string out of range",
+                {**sample, "xl/sharedStrings.xml": "<sst/>"},
+                None,
+            ),
+            (
+                "bad shared string index",
+                {
+                    **sample,
+                    "xl/worksheets/sheet1.xml": sheet.replace(
+                        b"<v>0</v>", b"<v>x</v>", 1
+                    ),
+                },
+                None,
+            ),
+        ]:
+            with self.subTest(name):
+                with self.assertRaises(ValidationError):
+                    get_header(get_zip_file(files, corrupted=corrupted))
+
+    def test_not_a_zip(self):
+        with self.assertRaises(ValidationError):
+            get_header(SimpleUploadedFile("document.xlsx", b"not a zip"))
+
+
+class TreeIdTest(TestCase):
+    def assertTreesAreSeparate(self, model):
+        roots = model.objects.filter(parent=None)
+        self.assertEqual(
+            roots.values("tree_id").distinct().count(), roots.count(), "shared tree id"
+        )
+        for root in roots:
+            self.assertEqual(
+                model.objects.filter(tree_id=root.tree_id).count(),
+                root.get_descendant_count() + 1,
+            )
+
+    def test_import_after_root_added_in_admin(self):
+        first_year = create_municipality_year("Prva")
+        second_year = create_municipality_year("Druga")
+        document = first_year.plannedexpensedocument_related.get()
+        XLSXAppraBudget(document, PlannedExpense).parse_file("files/proracun_apra.xlsx")
+        max_tree_id = PlannedExpense.objects.order_by("tree_id").last().tree_id
+
+        # order_insertion_by puts the root in front and shifts all trees
+        root = PlannedExpense(
+            name="Nov",
+            code="00",
+            order=0,
+            instructions="",
+            municipality=first_year.municipality,
+            year=first_year.financial_year,
+            document=document,
+        )
+        root.save()
+        self.assertEqual(root.tree_id, 1)
+        self.assertEqual(
+            PlannedExpense.objects.order_by("tree_id").last().tree_id, max_tree_id + 1
+        )
+
+        document = second_year.plannedexpensedocument_related.get()
+        XLSXAppraBudget(document, PlannedExpense).parse_file("files/proracun_apra.xlsx")
+        self.assertTreesAreSeparate(PlannedExpense)
+
+
+class DocumentUploadTest(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = override_settings(PARSE_ON_UPLOAD=True, MEDIA_ROOT=media_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        municipality_year = create_municipality_year("Prva")
+        self.document = municipality_year.monthlyrevenuedocument_related.get()
+
+    def test_rows_read_on_upload(self):
+        with open("files/prihodki_apra.xlsx", "rb") as f:
+            self.document.file = SimpleUploadedFile("prihodki.xlsx", f.read())
+        self.document.save()
+        self.assertEqual(
+            load_xlsx_rows(self.document.parsed_rows),
+            list(iter_xlsx_rows("files/prihodki_apra.xlsx"))[1:],
+        )
+
+    def test_imported_file_is_not_downloaded(self):
+        with open("files/prihodki_apra.xlsx", "rb") as f:
+            self.document.file = SimpleUploadedFile("prihodki.xlsx", f.read())
+        self.document.save()
+        task = Task.objects.get()
+        with self.assertLogs("obcine.models", "INFO"):
+            task.run()
+        self.assertEqual(task.status(), "finished")
+
+        # a task of the same file, e.g. queued before the import finished
+        task = Task.objects.create(name=task.name, payload=task.payload)
+        with override_settings(ENABLE_S3=True):
+            with mock.patch("obcine.models.download_file") as download_file:
+                task.run()
+        download_file.assert_not_called()
+        self.assertEqual(task.status(), "skipped")
+
+    def test_broken_rows_are_left_to_the_task(self):
+        # the header is valid, strings of other rows are missing
+        files = get_sample_files("files/prihodki_apra.xlsx")
+        shared_strings = files["xl/sharedStrings.xml"]
+        files["xl/sharedStrings.xml"] = (
+            shared_strings[: shared_strings.index(b"<si><t>0</t></si>")] + b"</sst>"
+        )
+        self.document.file = get_zip_file(files)
+        get_header(self.document.file)
+        self.document.save()
+        self.assertIsNone(self.document.parsed_rows)
+
+        task = Task.objects.get()
+        task.run()
+        self.assertEqual(task.status(), "retrying")
+        self.assertIn("IndexError", task.error_msg)
+
+
+class IncrementalImportTest(TestCase):
+    """
+    Checks that incremental imports save the same data as full imports
+    """
+
+    def setUp(self):
+        self.municipality_year = create_municipality_year("Prva")
+        self.municipality = self.municipality_year.municipality
+
+    def get_rows(self, path, columns):
+        return list(iter_xlsx_rows(path, columns=columns))[1:]
+
+    def get_expenses(self):
+        expenses = list(
+            MonthlyExpense.objects.filter(municipality=self.municipality)
+            .order_by("tree_id", "lft")
+            .values(
+                "name", "code", "order", "amount", "level", "lft", "rght", "tree_id"
+            )
+        )
+        # tree ids of a full import follow the largest saved one, only their
+        # order matters
+        tree_ids = sorted({expense["tree_id"] for expense in expenses})
+        for expense in expenses:
+            expense["tree_id"] = tree_ids.index(expense["tree_id"])
+        return expenses
+
+    def get_edited_budget_rows(self):
+        rows = [
+            list(row)
+            for row in self.get_rows("files/realizacija_apra.xlsx", BUDGET_COLUMNS)
+        ]
+        for row in rows[::7]:
+            row[16] += 100
+        del rows[40:60]
+        # new K4 in an existing program and a new tree in front of the others
+        rows.insert(100, rows[100][:10] + ["4999", "Nov konto"] + rows[100][12:])
+        codes = ["00", "0000", "00000000", "00000", "4000"]
+        path = [value for code in codes for value in [code, "Nov"]]
+        rows.insert(0, ["", "", *path, "", "", 0.0, 0.0, 1.5])
+        return rows
+
+    def test_budget(self):
+        document = self.municipality_year.monthlyexpensedocument_related.get()
+        budget_rows = self.get_rows("files/proracun_apra.xlsx", BUDGET_COLUMNS)
+        realized_rows = self.get_rows("files/realizacija_apra.xlsx", BUDGET_COLUMNS)
+        edited_rows = self.get_edited_budget_rows()
+
+        XLSXAppraBudget(document, MonthlyExpense).import_rows(iter(budget_rows))
+        for rows in [realized_rows, edited_rows, budget_rows, edited_rows]:
+            XLSXAppraBudget(document, MonthlyExpense, incremental=True).import_rows(
+                iter(rows)
+            )
+            expenses = self.get_expenses()
+            XLSXAppraBudget(document, MonthlyExpense).import_rows(iter(rows))
+            self.assertEqual(expenses, self.get_expenses())
+
+            # roots are listed in the order of the sheet
+            roots = MonthlyExpense.objects.filter(
+                municipality=self.municipality, parent=None
+            ).order_by("tree_id")
+            self.assertEqual(
+                [root.code for root in roots],
+                list(dict.fromkeys([row[2].strip() for row in rows])),
+            )
+
+        delta = XLSXAppraBudget(document, MonthlyExpense, incremental=True).import_rows(
+            iter(edited_rows)
+        )
+        self.assertEqual(delta, {"inserted": 0, "updated": 0, "deleted": 0})
+
+    def get_revenues(self):
+        return sorted(
+            MonthlyRevenue.objects.filter(municipality=self.municipality).values_list(
+                "name", "code", "amount", "definition_id"
+            )
+        )
+
+    def test_revenue(self):
+        document = self.municipality_year.monthlyrevenuedocument_related.get()
+        planned_rows = self.get_rows("files/prihodki_plan_apra.xlsx", REVENUE_COLUMNS)
+        realized_rows = self.get_rows("files/prihodki_apra.xlsx", REVENUE_COLUMNS)
+        edited_rows = [list(row) for row in realized_rows]
+        edited_rows[3][3] += 10
+        del edited_rows[5]
+        edited_rows.append(["", "799999", "Nov", 3.0])
+        # rows with the same code are matched in order
+        edited_rows.append(edited_rows[0])
+
+        def import_rows(rows, incremental=False):
+            return XLSXAppraRevenue(
+                document, MonthlyRevenue, RevenueDefinition, incremental=incremental
+            ).import_rows(iter(rows))
+
+        import_rows(planned_rows)
+        for rows in [realized_rows, edited_rows, planned_rows]:
+            import_rows(rows, incremental=True)
+            revenues = self.get_revenues()
+            import_rows(rows)
+            self.assertEqual(revenues, self.get_revenues())
+
+        delta = import_rows(planned_rows, incremental=True)
+        self.assertEqual(delta, {"inserted": 0, "updated": 0, "deleted": 0})
+
+
+def create_task(**kwargs):
+    return Task.objects.create(name="Test", payload={}, **kwargs)
+
+
+class TaskClaimTest(TestCase):
+    def test_claimed_task_is_started(self):
+        task = create_task()
+        self.assertEqual(Task.claim(), task)
+        task.refresh_from_db()
+        self.assertEqual(task.status(), "running")
+        self.assertEqual(task.attempts, 1)
+        self.assertIsNone(Task.claim())
+
+    def test_tasks_are_claimed_in_order(self):
+        tasks = [create_task() for i in range(3)]
+        self.assertEqual([Task.claim() for task in tasks], tasks)
+        self.assertIsNone(Task.claim())
+
+    def test_done_tasks_are_not_claimed(self):
+        create_task(skipped_at=timezone.now())
+        create_task(started_at=timezone.now(), finished_at=timezone.now())
+        self.assertIsNone(Task.claim())
+
+    def test_priority(self):
+        first = create_task()
+        high_priority = create_task(priority=10)
+        second = create_task()
+        self.assertEqual(Task.claim(), high_priority)
+        self.assertEqual(Task.claim(), first)
+        self.assertEqual(Task.claim(), second)
+
+    def test_lane(self):
+        backfill = create_task(lane=Task.Lane.BACKFILL, priority=10)
+        interactive = create_task(lane=Task.Lane.INTERACTIVE)
+        self.assertEqual(Task.claim(lane=Task.Lane.INTERACTIVE), interactive)
+        self.assertIsNone(Task.claim(lane=Task.Lane.INTERACTIVE))
+        self.assertEqual(Task.claim(), backfill)
+
+
+class TaskCoalescingTest(TestCase):
+    def setUp(self):
+        municipality_year = create_municipality_year("Prva")
+        self.document = municipality_year.monthlyrevenuedocument_related.get()
+
+    def parse(self, document):
+        document.parse(
+            parser=XLSXAppraRevenue, model=MonthlyRevenue, definition=RevenueDefinition
+        )
+        return Task.objects.latest("id")
+
+    def test_pending_tasks_are_superseded(self):
+        started = self.parse(self.document)
+        started.start()
+        first = self.parse(self.document)
+        other_document = create_municipality_year(
+            "Druga"
+        ).monthlyrevenuedocument_related.get()
+        other = self.parse(other_document)
+        last = self.parse(self.document)
+
+        for task in [started, first, other, last]:
+            task.refresh_from_db()
+        self.assertEqual(first.status(), "skipped")
+        # the running task and tasks of other documents are left alone
+        self.assertEqual(started.status(), "running")
+        self.assertEqual(other.status(), "pending")
+        self.assertEqual(last.status(), "pending")
+
+
+@override_settings(TASK_MAX_ATTEMPTS=3, TASK_RETRY_BACKOFF=60, TASK_TIMEOUT=1800)
+class TaskRetryTest(TestCase):
+    def fail_task(self, task):
+        try:
+            raise ValueError("Broken file")
+        except ValueError:
+            task.fail()
+
+    def test_retry_after_backoff(self):
+        task = create_task()
+        for attempt, delay in [(1, 60), (2, 120)]:
+            self.assertEqual(Task.claim(), task)
+            task.refresh_from_db()
+            self.assertEqual(task.attempts, attempt)
+            self.fail_task(task)
+            self.assertEqual(task.status(), "retrying")
+            self.assertIn("Broken file", task.error_msg)
+            self.assertAlmostEqual(
+                (task.run_after - timezone.now()).total_seconds(), delay, delta=5
+            )
+            # retrying tasks wait for run_after
+            self.assertIsNone(Task.claim())
+            Task.objects.filter(id=task.id).update(run_after=timezone.now())
+
+        self.assertEqual(Task.claim(), task)
+        task.refresh_from_db()
+        self.fail_task(task)
+        self.assertEqual(task.status(), "failed")
+        self.assertIsNotNone(task.errored_at)
+        self.assertIsNone(Task.claim())
+
+    def test_abandoned_task(self):
+        started_at = timezone.now() - timedelta(seconds=2 * 1800 + 1)
+        task = create_task(started_at=started_at, attempts=2)
+        self.assertEqual(Task.claim(), task)
+        task.refresh_from_db()
+        self.assertEqual(task.attempts, 3)
+
+        # the runner was killed on the last attempt
+        Task.objects.filter(id=task.id).update(started_at=started_at)
+        self.assertIsNone(Task.claim())
+        task.refresh_from_db()
+        self.assertEqual(task.status(), "failed")
+        self.assertIn("3 attempts", task.error_msg)
+
+    def test_running_task_is_not_abandoned(self):
+        create_task(started_at=timezone.now() - timedelta(seconds=1800), attempts=1)
+        self.assertIsNone(Task.claim())
+
+
+class StorageRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves sample files like the storage, /truncated/ paths stop in the
+    middle of the file
+    """
+
+    send_etag = True
+    handled_requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_file(self, send_body):
+        self.handled_requests.append((self.command, self.path))
+        path = self.path.replace("/truncated/", "/")
+        try:
+            with open(f"files{path}", "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        if self.send_etag:
+            self.send_header("ETag", f'"{hashlib.md5(data).hexdigest()}"')
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if send_body:
+            if path != self.path:
+                data = data[: len(data) // 2]
+            self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.send_file(send_body=False)
+
+    def do_GET(self):
+        self.send_file(send_body=True)
+
+
+class DownloadFileTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), StorageRequestHandler
+        )
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = cache_dir.name
+        settings = override_settings(DOWNLOAD_CACHE_DIR=self.cache_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        StorageRequestHandler.send_etag = True
+        StorageRequestHandler.handled_requests = []
+
+    def download(self, name):
+        host, port = self.server.server_address
+        return download_file(f"http://{host}:{port}/{name}", name)
+
+    def get_requests(self, command):
+        return [
+            path
+            for method, path in StorageRequestHandler.handled_requests
+            if method == command
+        ]
+
+    def assertDownloaded(self, file_path, name):
+        with open(file_path, "rb") as downloaded, open(f"files/{name}", "rb") as f:
+            self.assertEqual(downloaded.read(), f.read())
+
+    def test_cached_by_etag(self):
+        file_path = self.download("prihodki_apra.xlsx")
+        self.assertDownloaded(file_path, "prihodki_apra.xlsx")
+        self.assertEqual(self.download("prihodki_apra.xlsx"), file_path)
+        self.assertEqual(self.get_requests("HEAD"), ["/prihodki_apra.xlsx"] * 2)
+        self.assertEqual(self.get_requests("GET"), ["/prihodki_apra.xlsx"])
+
+    def test_cached_by_content_without_etag(self):
+        StorageRequestHandler.send_etag = False
+        file_path = self.download("prihodki_apra.xlsx")
+        self.assertDownloaded(file_path, "prihodki_apra.xlsx")
+        # the file is downloaded again, but stored only once
+        self.assertEqual(self.download("prihodki_apra.xlsx"), file_path)
+        self.assertEqual(self.get_requests("GET"), ["/prihodki_apra.xlsx"] * 2)
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(file_path)])
+
+    def test_least_recently_used_files_are_evicted(self):
+        names = ["prihodki_apra.xlsx", "prihodki_plan_apra.xlsx"]
+        last_name = "real-zr-2021-apra-prihodki.xlsx"
+        # only the last two files fit into the cache
+        max_size = sum([os.path.getsize(f"files/{name}") for name in names[1:]])
+        max_size += os.path.getsize(f"files/{last_name}")
+        with override_settings(DOWNLOAD_CACHE_MAX_SIZE=max_size):
+            paths = {name: self.download(name) for name in names}
+            # mtimes of files downloaded at once can be equal
+            for age, path in enumerate(paths.values(), start=1):
+                os.utime(path, (time.time() - 100 * age, time.time() - 100 * age))
+            # using the older file makes the other one least recently used
+            self.assertEqual(self.download(names[1]), paths[names[1]])
+            file_path = self.download(last_name)
+
+        self.assertCountEqual(
+            os.listdir(self.cache_dir),
+            [os.path.basename(file_path), os.path.basename(paths[names[1]])],
+        )
+
+    def test_failed_download_is_removed(self):
+        for name, error in [
+            ("missing.xlsx", requests.HTTPError),
+            ("truncated/prihodki_apra.xlsx", requests.RequestException),
+        ]:
+            with self.subTest(name):
+                with self.assertRaises(error):
+                    self.download(name)
+                self.assertEqual(os.listdir(self.cache_dir), [])
@@ -0,0 +1,33 @@
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+
+class PhaseTimer(object):
+    """
+    Measures duration and number of database queries of phases of a task.
+    Phases must not be nested, queries would be counted twice.
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Yields a dict of the phase, rows can be set on it during the phase
+        """
+        phase = {"seconds": 0, "queries": 0, "rows": None}
+        self.phases[name] = phase
+
+        def count_query(execute, sql, params, many, context):
+            phase["queries"] += 1
+            return execute(sql, params, many, context)
+
+        start_time = time.perf_counter()
+        try:
+            with connection.execute_wrapper(count_query):
+                yield phase
+        finally:
+            phase["seconds"] = round(time.perf_counter() - start_time, 3)
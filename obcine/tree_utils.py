@@ -1,73 +1,310 @@
-from django.db.models import Sum
-from mptt.utils import get_cached_trees
-
-
-def build_tree(definiton_storage, items):
-    parent_level = {}
-    parent = None
+import json
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from collections import namedtuple
+from collections.abc import Mapping
+from decimal import Decimal
+from types import MappingProxyType
+
+from django.db.models import Count, Max, Sum
+
+# values of expense rows needed by build_tree_from_rows
+EXPENSE_TREE_FIELDS = ["level", "name", "code", "amount", "parent_id"]
+
+AMOUNT_KEYS = ["amount", "planned", "realized"]
+
+# definition indexes of the process by definition model
+definition_indexes = {}
+definition_indexes_lock = threading.Lock()
+
+
+def aggregate_tree(definiton_storage, items, amount_keys):
+    """
+    Adds items under their parents from definiton_storage and sums amounts
+    of parents from their children. Items can be on any level of the tree.
+    Returns roots in the order of their first item.
+    """
+    roots = []
+    parents = {}
 
     for item in items:
-        parent = definiton_storage[item["parent_id"]]
-        if parent.id in parent_level.keys():
-            parent_level[parent.id]["amount"] += item["amount"]
-            parent_level[parent.id]["children"].append(item)
+        node = item
+        parent_id = item["parent_id"]
+        # go up only until a parent which is already in the tree
+        while parent_id is not None:
+            if parent_id in parents:
+                parents[parent_id]["children"].append(node)
+                break
+            definition = definiton_storage[parent_id]
+            parent = {
+                "name": definition.name,
+                "code": definition.code,
+                "children": [node],
+                "parent_id": definition.parent_id,
+            }
+            parents[parent_id] = parent
+            node = parent
+            parent_id = definition.parent_id
         else:
-            parent.amount = item["amount"]
-            parent.children = [item]
-            parent_level[parent.id] = parent.get_offline_dict()
-
-    if parent and parent.parent:
-        return build_tree(definiton_storage, parent_level.values())
-    else:
-        return parent_level
-
+            roots.append(node)
 
-def build_merged_tree(definiton_storage, items):
-    parent_level = {}
-    parent = None
-
-    for item in items:
-        parent = definiton_storage[item["parent_id"]]
-        if parent.id in parent_level.keys():
-            parent_level[parent.id]["planned"] += item["planned"]
-            parent_level[parent.id]["realized"] += item["realized"]
-            parent_level[parent.id]["children"].append(item)
-        else:
-            parent.amount = item["planned"]
-            parent.children = [item]
-            parent_level[parent.id] = parent.get_offline_dict()
-            parent_level[parent.id].pop("amount")
-            parent_level[parent.id]["planned"] = item["planned"]
-            parent_level[parent.id]["realized"] = item["realized"]
+    def sum_amounts(node):
+        # children are summed before their parent, every node once
+        for child in node["children"]:
+            sum_amounts(child)
+        if node["children"]:
+            for key in amount_keys:
+                node[key] = sum([child[key] for child in node["children"]])
 
-    if parent and parent.parent:
-        return build_merged_tree(definiton_storage, parent_level.values())
-    else:
-        return parent_level
+    for root in roots:
+        sum_amounts(root)
+    return roots
 
 
-def get_nested_dictionary_from_tree(queryset, remove_amount):
-    roots = get_cached_trees(queryset)
-
-    def form_a_tree(objects):
-        tree = dict()
+def build_tree(definiton_storage, items):
+    return aggregate_tree(definiton_storage, items, ["amount"])
 
-        for obj in objects:
-            children = obj.get_children()
-            dictionary_category_tree = obj.get_offline_dict_keyed_children()
-            if remove_amount:
-                dictionary_category_tree["realized"] = 0
-                dictionary_category_tree["planned"] = dictionary_category_tree["amount"]
-                dictionary_category_tree.pop("amount")
 
-            if children:
-                dictionary_category_tree.update({"children": form_a_tree(children)})
+def build_merged_tree(definiton_storage, items):
+    return aggregate_tree(definiton_storage, items, ["planned", "realized"])
+
+
+def build_tree_from_rows(rows):
+    """
+    Builds nested dicts from rows of EXPENSE_TREE_FIELDS ordered by tree_id
+    and lft in one pass. Amounts of parents are sums of their children.
+    """
+    roots = []
+    # nodes from the root of the current tree to the previous row
+    path = []
+
+    def close_nodes(level):
+        # children are closed before their parent, so their sums are known
+        while len(path) > level:
+            node = path.pop()
+            if node["children"]:
+                node["amount"] = sum([child["amount"] for child in node["children"]])
+
+    for level, name, code, amount, parent_id in rows:
+        close_nodes(level)
+        node = {
+            "name": name,
+            "code": code,
+            "children": [],
+            "amount": amount,
+            "parent_id": parent_id,
+        }
+        if path:
+            path[-1]["children"].append(node)
+        else:
+            roots.append(node)
+        path.append(node)
+    close_nodes(0)
+
+    return roots
+
+
+class CompactTree(object):
+    """
+    Tree of nested node dicts stored in parallel arrays, nodes are in
+    pre-order and amounts are in cents. It pickles into a small compressed
+    blob and is used as the list of roots, nodes are read through TreeNode.
+    """
+
+    def __init__(self, codes, names, parents, amounts):
+        self.codes = codes
+        self.names = names
+        # index of the parent node, -1 for roots
+        self.parents = parents
+        # array of cents for each amount key
+        self.amounts = amounts
+
+        self.roots = []
+        self.children = [[] for code in codes]
+        for index, parent in enumerate(parents):
+            if parent < 0:
+                self.roots.append(index)
+            else:
+                self.children[parent].append(index)
+
+    @classmethod
+    def from_nodes(cls, roots):
+        codes = []
+        names = []
+        parents = array("i")
+        amount_keys = [key for key in AMOUNT_KEYS if roots and key in roots[0]]
+        amounts = {key: array("q") for key in amount_keys}
+
+        stack = [(root, -1) for root in reversed(roots)]
+        while stack:
+            node, parent = stack.pop()
+            index = len(codes)
+            codes.append(node["code"])
+            names.append(sys.intern(node["name"]))
+            parents.append(parent)
+            for key in amount_keys:
+                amounts[key].append(int((Decimal(node[key]) * 100).to_integral_value()))
+            stack.extend((child, index) for child in reversed(node["children"]))
+
+        return cls(codes, names, parents, amounts)
+
+    def to_bytes(self):
+        header = json.dumps(
+            {"codes": self.codes, "names": self.names, "amounts": list(self.amounts)}
+        ).encode()
+        return zlib.compress(
+            b"".join(
+                [
+                    struct.pack("<I", len(header)),
+                    header,
+                    self.parents.tobytes(),
+                    *[cents.tobytes() for cents in self.amounts.values()],
+                ]
+            )
+        )
 
-            tree[dictionary_category_tree["code"]] = dictionary_category_tree
+    @classmethod
+    def from_bytes(cls, data):
+        data = zlib.decompress(data)
+        (header_size,) = struct.unpack_from("<I", data)
+        offset = struct.calcsize("<I") + header_size
+        header = json.loads(data[struct.calcsize("<I") : offset])
+
+        arrays = []
+        for typecode in ["i"] + ["q"] * len(header["amounts"]):
+            values = array(typecode)
+            size = values.itemsize * len(header["codes"])
+            values.frombytes(data[offset : offset + size])
+            offset += size
+            arrays.append(values)
+
+        return cls(
+            header["codes"],
+            [sys.intern(name) for name in header["names"]],
+            arrays[0],
+            dict(zip(header["amounts"], arrays[1:])),
+        )
 
-        return tree
+    def __reduce__(self):
+        # cached trees are pickled
+        return (CompactTree.from_bytes, (self.to_bytes(),))
 
-    return form_a_tree(roots)
+    def __len__(self):
+        return len(self.roots)
+
+    def __getitem__(self, index):
+        return TreeNode(self, self.roots[index])
+
+    def __iter__(self):
+        return (TreeNode(self, index) for index in self.roots)
+
+
+class TreeNode(Mapping):
+    """
+    Read only view of a node of CompactTree with the keys of node dicts
+    """
+
+    __slots__ = ["tree", "index"]
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def __getitem__(self, key):
+        if key == "name":
+            return self.tree.names[self.index]
+        if key == "code":
+            return self.tree.codes[self.index]
+        if key == "children":
+            return [
+                TreeNode(self.tree, child) for child in self.tree.children[self.index]
+            ]
+        if key in self.tree.amounts:
+            return Decimal(self.tree.amounts[key][self.index]).scaleb(-2)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(["name", "code", "children", *self.tree.amounts])
+
+    def __len__(self):
+        return 3 + len(self.tree.amounts)
+
+
+class Definition(namedtuple("Definition", ["id", "name", "code", "parent_id"])):
+    """
+    Read only definition
+    """
+
+    __slots__ = ()
+
+    def get_node(self, **amounts):
+        """
+        Returns a new node dict of the definition with given amounts
+        """
+        return {
+            "name": self.name,
+            "code": self.code,
+            "children": [],
+            **amounts,
+            "parent_id": self.parent_id,
+        }
+
+
+class DefinitionIndex(Mapping):
+    """
+    Definitions by id, shared by all requests and threads of the process.
+    It is never changed, a new index replaces it when definitions change.
+    """
+
+    def __init__(self, version, definitions):
+        self.version = version
+        self.definitions = MappingProxyType(definitions)
+
+    @classmethod
+    def load(cls, definition_model, version):
+        rows = definition_model.objects.values_list("id", "name", "code", "parent_id")
+        definitions = {row[0]: Definition(*row) for row in rows.iterator()}
+        return cls(version, definitions)
+
+    def __getitem__(self, id):
+        return self.definitions[id]
+
+    def __iter__(self):
+        return iter(self.definitions)
+
+    def __len__(self):
+        return len(self.definitions)
+
+
+def get_definition_version(definition_model):
+    """
+    Changes when definitions are added, edited or deleted in any process
+    """
+    return tuple(
+        definition_model.objects.aggregate(
+            count=Count("id"), last_id=Max("id"), updated_at=Max("updated_at")
+        ).values()
+    )
+
+
+def get_definition_index(definition_model):
+    """
+    Returns the definition index of the process, it is loaded only when
+    definitions changed since the last call
+    """
+    version = get_definition_version(definition_model)
+    index = definition_indexes.get(definition_model)
+    if index is None or index.version != version:
+        # other threads wait for the index instead of loading it again
+        with definition_indexes_lock:
+            index = definition_indexes.get(definition_model)
+            if index is None or index.version != version:
+                index = DefinitionIndex.load(definition_model, version)
+                definition_indexes[definition_model] = index
+    return index
 
 
 class RevenueTreeBuilder:
@@ -80,7 +317,7 @@ class RevenueTreeBuilder:
     ):
         self.municipality = municipality
         self.financial_year = financial_year
-        self.definiton_storage = definition_model.get_id_value_dict()
+        self.definiton_storage = get_definition_index(definition_model)
         self.leaf_parent_key = leaf_parent_key
 
     def get_revenue_tree(self, data_model):
@@ -96,16 +333,13 @@ class RevenueTreeBuilder:
         )
 
         leaves = []
-        definiton_keys = self.definiton_storage.keys()
         for revenue in revenues:
-            if not revenue[self.leaf_parent_key] in definiton_keys:
+            if not revenue[self.leaf_parent_key] in self.definiton_storage:
                 continue  # skip invalid items
-            item = self.definiton_storage[revenue[self.leaf_parent_key]]
-            item.amount = revenue["sum_amount"]
-            item.children = []
-            leaves.append(item.get_offline_dict())
+            definition = self.definiton_storage[revenue[self.leaf_parent_key]]
+            leaves.append(definition.get_node(amount=revenue["sum_amount"]))
 
-        return list(build_tree(self.definiton_storage, leaves).values())
+        return build_tree(self.definiton_storage, leaves)
 
     def get_merged_revenue_tree(self, planned_data_model, realized_data_model):
         planned_revenues = planned_data_model.objects.filter(
@@ -134,27 +368,25 @@ class RevenueTreeBuilder:
 
         all_keys = set(planned_dict.keys()) | set(realized_dict.keys())
 
-        definiton_keys = list(self.definiton_storage.keys())
-
         leaves = []
         for key in all_keys:
             planned = planned_dict.get(key, {})
             realized = realized_dict.get(key, {})
             if planned and planned[self.leaf_parent_key]:
-                item = self.definiton_storage[planned[self.leaf_parent_key]]
+                definition = self.definiton_storage[planned[self.leaf_parent_key]]
             elif realized and realized[self.leaf_parent_key]:
-                item = self.definiton_storage[realized[self.leaf_parent_key]]
+                definition = self.definiton_storage[realized[self.leaf_parent_key]]
             else:
                 print("Skipping invalid item")
                 continue
-            item.amount = planned.get("sum_amount", 0)
-            item.children = []
-            item_dict = item.get_offline_dict()
-            item_dict["planned"] = item_dict.pop("amount")
-            item_dict["realized"] = realized.pop("sum_amount", 0)
-            leaves.append(item_dict)
+            leaves.append(
+                definition.get_node(
+                    planned=planned.get("sum_amount", 0),
+                    realized=realized.get("sum_amount", 0),
+                )
+            )
 
-        return list(build_merged_tree(self.definiton_storage, leaves).values())
+        return build_merged_tree(self.definiton_storage, leaves)
 
 
 class ExpenseTreeBuilder:
@@ -163,58 +395,56 @@ class ExpenseTreeBuilder:
         self.financial_year = financial_year
 
     def get_expense_tree(self, data_model):
-        expenses = data_model.objects.filter(
-            municipality=self.municipality,
-            year=self.financial_year,
-        )
-        self.definiton_storage = {expense.id: expense for expense in expenses}
-        try:
-            data = list(
-                build_tree(
-                    self.definiton_storage,
-                    [
-                        expanse.get_offline_dict()
-                        for expanse in expenses.filter(level=4)
-                    ],
-                ).values()
+        expenses = (
+            data_model.objects.filter(
+                municipality=self.municipality,
+                year=self.financial_year,
             )
-        except KeyError:
-            data = []
-        return data
-
-    def get_merged_expense_tree(self, planned_data_model, realized_data_model):
-        planned_expenses = planned_data_model.objects.filter(
-            municipality=self.municipality,
-            year=self.financial_year,
-        )
-        realized_expenses = realized_data_model.objects.filter(
-            municipality=self.municipality,
-            year=self.financial_year,
-        )
-        planned_tree = get_nested_dictionary_from_tree(
-            planned_expenses, remove_amount=True
-        )
-        realized_tree = get_nested_dictionary_from_tree(
-            realized_expenses, remove_amount=False
+            .order_by("tree_id", "lft")
+            .values_list(*EXPENSE_TREE_FIELDS)
         )
+        return build_tree_from_rows(expenses.iterator())
 
-        def update_realized(subtree, realized_subtree):
-            for item in subtree.values():
-                if item["code"] in realized_subtree.keys():
-                    item["realized"] = realized_subtree[item["code"]]["amount"]
-                    if "children" in item.keys():
-                        update_realized(
-                            item["children"], realized_subtree[item["code"]]["children"]
-                        )
-
-        def listify_children(tree):
-            tree = list(tree.values())
-            for item in tree:
-                if "children" in item.keys():
-                    item["children"] = listify_children(item["children"])
-            return list(tree)
-
-        update_realized(planned_tree, realized_tree)
-
-        planned_tree = listify_children(planned_tree)
-        return planned_tree
+    def get_merged_expense_tree(self, planned_data_model, realized_data_model):
+        """
+        Matches planned and realized nodes by the codes on the path from the
+        root. Realized nodes missing in the plan are added after the planned
+        siblings with planned amount 0.
+        """
+        roots = []
+        # nodes indexed by the codes on the path from the root
+        nodes = {}
+
+        for amount_key, data_model in [
+            ("planned", planned_data_model),
+            ("realized", realized_data_model),
+        ]:
+            expenses = (
+                data_model.objects.filter(
+                    municipality=self.municipality,
+                    year=self.financial_year,
+                )
+                .order_by("tree_id", "lft")
+                .values_list("level", "name", "code", "amount")
+            )
+            path = []
+            for level, name, code, amount in expenses.iterator():
+                # parents come before their children in tree order
+                del path[level:]
+                path.append(code)
+                key = tuple(path)
+                if key not in nodes:
+                    nodes[key] = {
+                        "name": name,
+                        "code": code,
+                        "children": [],
+                        "planned": 0,
+                        "realized": 0,
+                    }
+                    if level:
+                        nodes[key[:-1]]["children"].append(nodes[key])
+                    else:
+                        roots.append(nodes[key])
+                nodes[key][amount_key] = amount
+
+        return roots
@@ -100,6 +100,7 @@ class RevenueDefinitionAdmin(MPTTModelAdmin, LimitedAdmin):
 
 class DocumentTabularInline(admin.TabularInline):
     exclude = ["municipality", "year"]
+    readonly_fields = ["import_fingerprint"]
 
 
 class BudgetDocumentInlineAdmin(DocumentTabularInline):
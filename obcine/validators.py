@@ -1,9 +1,10 @@
 import os
 
-import xlrd
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 
+from obcine.xlsx_utils import XLSX_ERRORS, iter_xlsx_rows
+
 
 def document_size_validator(
     value,
@@ -30,9 +31,32 @@ def validate_image_extension(value):
         )
 
 
+def get_header(value):
+    """
+    Reads only the first row of the first sheet, rest of the file is not read
+    """
+    try:
+        header = next(iter_xlsx_rows(value, max_rows=1), [])
+    except XLSX_ERRORS:
+        raise ValidationError(_("Datoteka ni pravilno izvozena iz sitema APRA."))
+    finally:
+        value.seek(0)
+    # ignore empty cells at the end of the row
+    while header and header[-1] == "":
+        header.pop()
+    return header
+
+
+def validate_header(value, requierd_rows):
+    # files already saved to storage were validated when they were uploaded,
+    # don't download them again when the form is resubmitted
+    if getattr(value, "_committed", False):
+        return
+    if get_header(value) != requierd_rows:
+        raise ValidationError(_("Datoteka ni pravilno izvozena iz sitema APRA."))
+
+
 def validate_expanse_file(value):
-    book = xlrd.open_workbook(file_contents=value.read())
-    sheet = book.sheet_by_index(0)
     requierd_rows = [
         "PU_ID",
         "PU_OPIS",
@@ -52,13 +76,9 @@ def validate_expanse_file(value):
         "F2",
         "F3",
     ]
-    if sheet.row_values(0) != requierd_rows:
-        raise ValidationError(_("Datoteka ni pravilno izvozena iz sitema APRA."))
+    validate_header(value, requierd_rows)
 
 
 def validate_revenue_file(value):
-    book = xlrd.open_workbook(file_contents=value.read())
-    sheet = book.sheet_by_index(0)
     requierd_rows = ["BLC_ID", "K6_ID", "K6_OPIS", "VREDNOST_PRI"]
-    if sheet.row_values(0) != requierd_rows:
-        raise ValidationError(_("Datoteka ni pravilno izvozena iz sitema APRA."))
+    validate_header(value, requierd_rows)
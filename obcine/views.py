@@ -20,7 +20,7 @@ from obcine.models import (
     YearlyExpense,
     YearlyRevenue,
 )
-from obcine.tree_utils import ExpenseTreeBuilder, RevenueTreeBuilder
+from obcine.tree_utils import CompactTree, ExpenseTreeBuilder, RevenueTreeBuilder
 
 
 class OldUrlRedirectView(RedirectView):
@@ -216,7 +216,7 @@ def get_revenue_tree(municipality, year, summary, summary_type="monthly"):
             "realized": summary["realized_revenue"],
             "name": "Celotni prihodki",
             "code": None,
-            "children": merged_tree_revenues,
+            "children": CompactTree.from_nodes(merged_tree_revenues),
         }
 
     elif summary_type == "yearly":
@@ -226,7 +226,7 @@ def get_revenue_tree(municipality, year, summary, summary_type="monthly"):
             "realized": summary["realized_revenue"],
             "name": "Celotni prihodki",
             "code": None,
-            "children": realized_revenue,
+            "children": CompactTree.from_nodes(realized_revenue),
         }
     else:
         raise TypeError
@@ -259,7 +259,7 @@ def get_expense_tree(municipality, year, summary, summary_type="monthly"):
             "realized": summary["realized_expenses"],
             "name": "Celotni odhodki",
             "code": None,
-            "children": merged_tree_expenses,
+            "children": CompactTree.from_nodes(merged_tree_expenses),
         }
 
     elif summary_type == "yearly":
@@ -269,7 +269,7 @@ def get_expense_tree(municipality, year, summary, summary_type="monthly"):
             "realized": summary["realized_expenses"],
             "name": "Celotni odhodki",
             "code": None,
-            "children": realized_expenses,
+            "children": CompactTree.from_nodes(realized_expenses),
         }
     else:
         raise TypeError
@@ -0,0 +1,208 @@
+import json
+import posixpath
+import string
+import zipfile
+import zlib
+from functools import lru_cache
+from xml.etree.ElementTree import ParseError, iterparse
+
+# errors of reading a broken workbook: not a zip, missing parts, broken
+# compressed data or xml, a workbook without sheets and bad cell values
+XLSX_ERRORS = (
+    zipfile.BadZipFile,
+    zlib.error,
+    EOFError,
+    KeyError,
+    ParseError,
+    IndexError,
+    ValueError,
+)
+
+RELATIONSHIP_ID = (
+    "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+)
+
+
+def local_name(tag):
+    """
+    Returns tag without namespace, xlsx files use different namespaces
+    """
+    return tag.rsplit("}", 1)[-1]
+
+
+@lru_cache(maxsize=None)
+def column_index(column):
+    """
+    Converts column like "AB" to zero based column index
+    """
+    index = 0
+    for char in column:
+        index = index * 26 + ord(char) - ord("A") + 1
+    return index - 1
+
+
+def get_text(element):
+    return "".join(
+        child.text or "" for child in element.iter() if local_name(child.tag) == "t"
+    )
+
+
+class XLSXReader(object):
+    """
+    Reads rows of xlsx sheets one by one without loading the whole workbook
+    into memory. Text is returned as str, numbers as float and empty cells
+    as "".
+    """
+
+    def __init__(self, file):
+        # file can be a path or any seekable file object, e.g. uploaded file
+        self.zip_file = zipfile.ZipFile(file)
+        self.shared_strings = []
+        self.shared_strings_iterator = None
+
+    def close(self):
+        if self.shared_strings_iterator:
+            self.shared_strings_iterator.close()
+        self.zip_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_sheet_path(self, sheet_index):
+        targets = {}
+        with self.zip_file.open("xl/_rels/workbook.xml.rels") as f:
+            for event, element in iterparse(f):
+                if local_name(element.tag) == "Relationship":
+                    targets[element.get("Id")] = element.get("Target")
+
+        sheet_ids = []
+        with self.zip_file.open("xl/workbook.xml") as f:
+            for event, element in iterparse(f):
+                if local_name(element.tag) == "sheet":
+                    sheet_ids.append(element.get(RELATIONSHIP_ID))
+
+        target = targets[sheet_ids[sheet_index]]
+        if target.startswith("/"):
+            return target[1:]
+        return posixpath.normpath(posixpath.join("xl", target))
+
+    def iter_shared_strings(self):
+        if "xl/sharedStrings.xml" not in self.zip_file.namelist():
+            return
+        with self.zip_file.open("xl/sharedStrings.xml") as f:
+            for event, element in iterparse(f):
+                if local_name(element.tag) == "si":
+                    yield get_text(element)
+                    element.clear()
+
+    def get_shared_string(self, index):
+        """
+        Shared strings are read only as far as needed, so reading the header
+        does not parse strings of the whole workbook
+        """
+        if self.shared_strings_iterator is None:
+            self.shared_strings_iterator = self.iter_shared_strings()
+        while index >= len(self.shared_strings):
+            shared_string = next(self.shared_strings_iterator, None)
+            if shared_string is None:
+                raise IndexError(f"Shared string {index} is not in the workbook")
+            self.shared_strings.append(shared_string)
+        return self.shared_strings[index]
+
+    def get_value(self, cell, value_tag):
+        cell_type = cell.get("t", "n")
+        if cell_type == "inlineStr":
+            return get_text(cell)
+
+        value = cell.findtext(value_tag)
+        if not value:
+            return ""
+        if cell_type == "s":
+            return self.get_shared_string(int(value))
+        if cell_type == "n":
+            return float(value)
+        if cell_type == "b":
+            return bool(int(value))
+        return value
+
+    def iter_rows(self, sheet_index=0, columns=None, max_rows=None):
+        """
+        Yields lists of cell values. Only cells in columns are read when
+        columns are given, other cells stay empty. Empty rows are skipped.
+        """
+        row_count = 0
+        sheet_data = None
+        with self.zip_file.open(self.get_sheet_path(sheet_index)) as f:
+            events = iterparse(f, events=("start", "end"))
+            for event, element in events:
+                if sheet_data is None:
+                    if event == "start" and local_name(element.tag) == "sheetData":
+                        sheet_data = element
+                        # tags of the sheet are in the namespace of sheetData
+                        namespace = element.tag[: -len("sheetData")]
+                        row_tag = namespace + "row"
+                        value_tag = namespace + "v"
+                    continue
+                if event == "start" or element.tag != row_tag:
+                    continue
+
+                values = []
+                for i, cell in enumerate(element):
+                    reference = cell.get("r")
+                    if reference:
+                        index = column_index(reference.rstrip(string.digits))
+                    else:
+                        index = i
+                    if columns is not None and index not in columns:
+                        continue
+                    if index >= len(values):
+                        values.extend([""] * (index + 1 - len(values)))
+                    values[index] = self.get_value(cell, value_tag)
+
+                # drop parsed rows so memory does not grow with the sheet
+                sheet_data.clear()
+
+                if values:
+                    if columns is not None:
+                        # needed cells can be missing at the end of a row
+                        values.extend([""] * (max(columns) + 1 - len(values)))
+                    row_count += 1
+                    yield values
+
+                # stop before the rest of the sheet is read
+                if max_rows is not None and row_count >= max_rows:
+                    return
+
+
+def iter_xlsx_rows(file, sheet_index=0, columns=None, max_rows=None):
+    with XLSXReader(file) as reader:
+        yield from reader.iter_rows(
+            sheet_index=sheet_index, columns=columns, max_rows=max_rows
+        )
+
+
+def dump_xlsx_rows(file):
+    """
+    Returns rows of the first sheet without the header as compressed json.
+    Rows are padded to the width of the header. Every row is compressed when
+    it is read, so the sheet is never held in memory.
+    """
+    compressor = zlib.compressobj()
+    chunks = [compressor.compress(b"[")]
+    rows = iter_xlsx_rows(file)
+    header = next(rows, [])
+    for index, row in enumerate(rows):
+        row = row + [""] * (len(header) - len(row))
+        separator = "," if index else ""
+        chunks.append(compressor.compress((separator + json.dumps(row)).encode()))
+    chunks.append(compressor.compress(b"]"))
+    chunks.append(compressor.flush())
+    file.seek(0)
+    return b"".join(chunks)
+
+
+def load_xlsx_rows(data):
+    return json.loads(zlib.decompress(data))
@@ -158,6 +158,40 @@ AUTH_USER_MODEL = "obcine.User"
 
 ENABLE_S3 = os.getenv("ENABLE_S3", False)
 
+# documents downloaded from S3 for parsing are cached here
+DOWNLOAD_CACHE_DIR = os.getenv(
+    "DJANGO_DOWNLOAD_CACHE_DIR", os.path.join(BASE_DIR, "download_cache/")
+)
+DOWNLOAD_CACHE_MAX_SIZE = int(
+    os.getenv("DJANGO_DOWNLOAD_CACHE_MAX_SIZE", 200 * 1024 * 1024)
+)
+
+# read rows of uploaded documents during the upload request and import them
+# from the database instead of downloading and parsing the file again
+PARSE_ON_UPLOAD = os.getenv("PARSE_ON_UPLOAD", False)
+
+# tasks running longer than TASK_TIMEOUT seconds are aborted, failed tasks are
+# retried after TASK_RETRY_BACKOFF seconds, doubled on every next attempt
+TASK_TIMEOUT = int(os.getenv("DJANGO_TASK_TIMEOUT", 30 * 60))
+TASK_MAX_ATTEMPTS = int(os.getenv("DJANGO_TASK_MAX_ATTEMPTS", 3))
+TASK_RETRY_BACKOFF = int(os.getenv("DJANGO_TASK_RETRY_BACKOFF", 60))
+# finished, skipped and failed tasks are deleted after this many days
+TASK_RETENTION_DAYS = int(os.getenv("DJANGO_TASK_RETENTION_DAYS", 30))
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        "obcine": {
+            "handlers": ["console"],
+            "level": os.getenv("DJANGO_LOG_LEVEL", "INFO"),
+        },
+    },
+}
+
 # DJANGO STORAGE SETTINGS
 if os.getenv("ENABLE_S3", False):
     DEFAULT_FILE_STORAGE = "storages.backends.s3boto3.S3Boto3Storage"